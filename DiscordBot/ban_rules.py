@@ -0,0 +1,88 @@
+# Matcher for the regexes moderators ban with the `BAN:` command.
+
+import re
+
+# Characters that give a pattern a special meaning. A pattern without any of them only matches itself.
+REGEX_METACHARACTERS = set(".^$*+?{}[]\\|()")
+
+
+class BanRuleMatcher:
+    '''
+    Checks a message against every banned rule at once. Like re.fullmatch, a rule only matches if it
+    matches the whole message. Plain-literal rules can therefore only match a message equal to them, so
+    they're kept in a dictionary and cost one lookup regardless of how many there are. All other rules
+    are joined into a single alternation that is recompiled when a rule is added, so a message is scanned
+    once instead of once per rule. Rules that can't be safely joined (backreferences, conditional groups, global flags,
+    clashing group names) are checked on their own.
+    '''
+
+    def __init__(self):
+        self.rules = [] # All rules, in the order they were added
+        self.literals = {} # Map from literal rule text to the rule
+        self.regex_rules = [] # Rules in the combined pattern, in group order
+        self.regex_groups = [] # Group number in the combined pattern that wraps each of regex_rules
+        self.combined = None
+        self.standalone = [] # List of (rule, compiled pattern) checked one by one
+
+    def add(self, rule):
+        '''
+        Adds a rule. Raises re.error if the rule is not a valid regex.
+        '''
+        pattern = re.compile(rule)
+        if rule in self.rules:
+            return
+        self.rules.append(rule)
+
+        if not any(c in REGEX_METACHARACTERS for c in rule):
+            self.literals.setdefault(rule, rule)
+            return
+
+        if re.search(r'\\\d|\(\?P=|\(\?\(|^\(\?[aiLmsux]+\)', rule):
+            self.standalone.append((rule, pattern))
+            return
+
+        try:
+            self.combined = self.compile_combined(self.regex_rules + [rule])
+        except re.error:
+            self.standalone.append((rule, pattern))
+            return
+        self.regex_rules.append(rule)
+        self.regex_groups = self.group_numbers(self.regex_rules)
+
+    def match(self, text):
+        '''
+        Returns the first rule that matches the whole text, or None.
+        '''
+        rule = self.literals.get(text)
+        if rule is not None:
+            return rule
+
+        if self.combined is not None:
+            m = self.combined.fullmatch(text)
+            if m:
+                for rule, group in zip(self.regex_rules, self.regex_groups):
+                    if m.group(group) is not None:
+                        return rule
+
+        for rule, pattern in self.standalone:
+            if pattern.fullmatch(text):
+                return rule
+        return None
+
+    def compile_combined(self, rules):
+        return re.compile("|".join(f"({rule})" for rule in rules))
+
+    def group_numbers(self, rules):
+        # Each rule is wrapped in one extra group, followed by the groups the rule has itself.
+        numbers = []
+        group = 1
+        for rule in rules:
+            numbers.append(group)
+            group += 1 + re.compile(rule).groups
+        return numbers
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __iter__(self):
+        return iter(self.rules)
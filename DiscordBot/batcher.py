@@ -0,0 +1,70 @@
+# Collects items submitted from many coroutines and hands them to a handler in batches.
+
+import asyncio
+
+
+class MicroBatcher:
+    '''
+    Groups calls to `submit` into batches of up to `max_items` items, waiting at most `max_wait_ms`
+    for a batch to fill up. `handler` is an async function that takes a list of items and returns a list
+    of results in the same order. A result that is an Exception instance is raised to the caller that
+    submitted that item only; an exception raised by the handler itself fails every item in the batch.
+    '''
+
+    def __init__(self, handler, max_items=10, max_wait_ms=50):
+        self.handler = handler
+        self.max_items = max_items
+        self.max_wait_ms = max_wait_ms
+        self.pending = [] # List of (item, future) waiting for the next batch
+        self.flush_timer = None
+        self.tasks = set() # Batches being handled, kept here so they aren't garbage collected mid-run
+        self.batches_sent = 0
+        self.items_sent = 0
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+
+        if len(self.pending) >= self.max_items:
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = asyncio.get_running_loop().call_later(self.max_wait_ms / 1000, self.flush)
+
+        return await future
+
+    def flush(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if not self.pending:
+            return
+
+        batch = self.pending[:self.max_items]
+        self.pending = self.pending[self.max_items:]
+        task = asyncio.get_running_loop().create_task(self.run_batch(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+        # Anything left over starts a new batch window
+        if self.pending:
+            self.flush_timer = asyncio.get_running_loop().call_later(self.max_wait_ms / 1000, self.flush)
+
+    async def run_batch(self, batch):
+        self.batches_sent += 1
+        self.items_sent += len(batch)
+        items = [item for item, _ in batch]
+        try:
+            results = await self.handler(items)
+            if len(results) != len(items):
+                raise ValueError(f"Batch handler returned {len(results)} results for {len(items)} items")
+        except Exception as e:
+            results = [e] * len(items)
+
+        for (_, future), result in zip(batch, results):
+            # The caller may have given up on this item already (e.g. it timed out).
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -8,21 +8,34 @@ import re
 import requests
 import openai_utils
 import formatter 
-import editdistance
 from report import Report
 from review import Review
+from batcher import MicroBatcher
+from verdict_cache import VerdictCache
+from ban_rules import BanRuleMatcher
+from offenders import OffenderTracker, BANNED_POSTER, BANNED_REPORTER
+from state_store import StateStore
+from review_log import ReviewLogWriter
+from metrics import REGISTRY as metrics, WAIT_BUCKETS
+from resilience import CircuitBreaker
+from message_cache import MessageCache, ContentHashes
+from review_queue import ReviewQueue
+from spam_burst import SpamBurstDetector
+from outbound import OutboundActions
+from flood_control import FloodControl, LOCAL_ONLY, DELETE as FLOOD_DELETE
 import pdb
-import profanity_check
-from collections import OrderedDict
+import local_scoring
+from local_scoring import LocalScoringPool
+from collections import OrderedDict, deque
 import argparse
+import asyncio
+import time
+import log_setup
 
 
-# Set up logging to the console
-logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
+# Logging is configured in main() (see log_setup.py). Per-message traces go to their own logger so they can be sampled.
+logger = logging.getLogger('modbot')
+trace_logger = logging.getLogger(log_setup.TRACE_LOGGER)
 
 # There should be a file called 'tokens.json' inside the same folder as this file
 token_path = 'tokens.json'
@@ -33,16 +46,33 @@ with open(token_path) as f:
     tokens = json.load(f)
     discord_token = tokens['discord']
 
-banned_words_path = 'data/badwords.txt'
-logging_path = 'logging/log.txt'
+state_db_path = 'data/state.sqlite'
+logging_path = 'logging/reviews.jsonl'
+metrics_path = 'logging/metrics.prom'
 
-with open(banned_words_path) as f:
-    banned_words = set()
-    for line in f:
-        banned_words.add(line.strip())
+# profanity_check scores above these thresholds are deleted or forwarded to the moderators.
+PROFANITY_DELETE_THRESHOLD = 0.95
+PROFANITY_REPORT_THRESHOLD = 0.4
+
+# Seconds between writes of the metrics file
+METRICS_WRITE_INTERVAL = 15
+
+# What automatic detection decided to do with a message.
+DELETE = "delete"
+REPORT = "report"
+
+# Near-duplicate copies of a reported message are reported once more, as a burst, when this many have been posted.
+SPAM_BURST_REPORT_SIZE = 5
+
+# Number of completed reports and reviews kept in memory for the `debug` command. All of them are in the state store.
+RECENT_HISTORY = 100
 
 class ModBot(discord.Client):
-    def __init__(self, use_openai=False, debug=False): 
+    def __init__(self, use_openai=False, debug=False, openai_batch_size=1, openai_batch_ms=50, cache_db=None,
+                 profanity_batch_size=64, profanity_batch_ms=5, false_report_threshold=3, violation_threshold=3,
+                 state_db=state_db_path, metrics_file=metrics_path, cascade=False, cascade_low=0.1, cascade_high=PROFANITY_DELETE_THRESHOLD,
+                 openai_deadline=5.0, hedge=False, spam_window=120, flood_user_limit=10, flood_channel_limit=120, flood_window=10,
+                 digest_reports=False, local_workers=0, openai_slow_call=2.0): 
         intents = discord.Intents.default()
         intents.message_content = True
         super().__init__(command_prefix='.', intents=intents)
@@ -52,17 +82,158 @@ class ModBot(discord.Client):
         self.inprogress_reports = {} # Map from user IDs to the state of their in-progress report
         self.inprogress_reviews = {} # Map from user IDs to the state of their in-progress reviews
 
-        self.completed_reports = [] # All completed reports
-        self.completed_reviews = [] # All completed reviews
+        # Recent messages in the moderated and mod channels, so report and review links resolve without a REST call.
+        self.message_cache = MessageCache()
+        # Hash of the text each of those messages had when we last handled it, to skip edits that change nothing.
+        self.content_hashes = ContentHashes()
+
+        # Reports waiting in the mod channel, handed out by the `next` command in priority order.
+        self.review_queue = ReviewQueue()
+
+        self.completed_reports = deque(maxlen=RECENT_HISTORY) # Most recent completed reports
+        self.completed_reviews = deque(maxlen=RECENT_HISTORY) # Most recent completed reviews
 
-        self.banned_reporters = [] # All people banned due to making false reports
-        self.banned_posters = [] # All people banned due to violating content policies
+        # Reports, reviews, bans and banned regexes are saved here so they survive restarts.
+        self.state_store = StateStore(state_db) if state_db else None
+
+        # Completed reviews are also logged for later analysis (see tools/analyze_log.py).
+        self.review_log = ReviewLogWriter(logging_path)
+
+        # Hot-path timings and counters, shown by the `stats` command and written to metrics_file.
+        self.metrics = metrics
+        self.metrics_file = metrics_file
+        self.metrics_task = None
+
+        # Deletions, notices and (with digest_reports) mod reports are sent in bulk and kept under Discord's rate limits.
+        self.outbound = OutboundActions(self.metrics, digest_reports=digest_reports)
+
+        # Counts false reports and violations per user as reviews complete, and holds who is banned.
+        self.offenders = OffenderTracker(false_report_threshold, violation_threshold)
 
         self.mods = [1029345335748857917, 811498139017412608] # user IDs that are allowed to post / review messages in mod channel. 3q
         self.use_openai = use_openai
         self.debug = debug
 
-        self.regexes_to_ban = [] # Regex list that should not be allowed on the server.
+        # Cascade mode: profanity_check scores below cascade_low count as clean, above cascade_high are deleted,
+        # and only the messages in between are sent to OpenAI.
+        self.cascade = cascade
+        self.cascade_low = cascade_low
+        self.cascade_high = cascade_high
+
+        # OpenAI gets at most openai_deadline seconds per message. After repeated failed requests or requests slower
+        # than openai_slow_call the breaker sends messages straight to profanity_check for a while. With hedge on,
+        # profanity_check runs alongside every OpenAI request so falling back doesn't add any wait.
+        self.openai_deadline = openai_deadline
+        # The breaker only hears about the requests themselves (see openai_utils.set_circuit_breaker), while the
+        # deadline also covers waiting for a free request slot, so a local burst doesn't count against OpenAI.
+        self.openai_breaker = CircuitBreaker("OpenAI", slow_call_seconds=openai_slow_call)
+        openai_utils.set_circuit_breaker(self.openai_breaker)
+        self.hedge = hedge
+
+        # When batching is on, messages that arrive close together are scored with one OpenAI request.
+        self.openai_batcher = None
+        if openai_batch_size and openai_batch_size > 1:
+            self.openai_batcher = MicroBatcher(openai_utils.get_openai_batch_scores_async, openai_batch_size, openai_batch_ms)
+
+        # With local_workers, sanitizing and profanity_check run in that many worker processes instead of on the event loop.
+        self.local_workers = local_workers
+        self.local_pool = None
+
+        # Messages from all channels waiting for profanity_check are scored together in one vectorized call.
+        self.profanity_batcher = MicroBatcher(self.score_profanity_batch, profanity_batch_size, profanity_batch_ms)
+
+        # Verdicts for content we've already scored, keyed on the sanitized message text.
+        self.verdict_cache = VerdictCache(db_path=cache_db)
+
+        # Clusters of near-duplicate messages from the last spam_window seconds, so raids are only scored once.
+        self.spam_bursts = SpamBurstDetector(spam_window) if spam_window else None
+
+        # Users posting more than flood_user_limit messages per flood_window seconds have the extra ones deleted
+        # unscored, and past flood_channel_limit the channel is only scored locally.
+        self.flood_control = FloodControl(flood_user_limit, flood_channel_limit, flood_window) if flood_window else None
+
+        self.regexes_to_ban = BanRuleMatcher() # Regexes that should not be allowed on the server.
+
+    async def setup_hook(self):
+        '''
+        Called by discord.py once before connecting. Restores the moderation state saved by previous runs.
+        Only bans, banned regexes, per-user counters and the most recent history are loaded, not every report.
+        '''
+        if self.local_workers:
+            self.local_pool = LocalScoringPool(self.local_workers)
+            await self.local_pool.start()
+            logger.info("Started %d local scoring workers.", self.local_workers)
+
+        self.review_log.start()
+        self.verdict_cache.start()
+        if self.metrics_file:
+            self.metrics_task = asyncio.get_running_loop().create_task(self.write_metrics_periodically())
+
+        if not self.state_store:
+            return
+        store = self.state_store
+
+        for rule in await store.run(store.load_ban_rules):
+            try:
+                self.regexes_to_ban.add(rule)
+            except re.error:
+                logger.warning("Skipping saved regex '%s', it no longer compiles.", rule)
+
+        self.offenders.load(await store.run(store.load_false_report_counts),
+                            await store.run(store.load_violation_counts),
+                            await store.run(store.load_bans, BANNED_REPORTER),
+                            await store.run(store.load_bans, BANNED_POSTER))
+
+        self.completed_reports.extend(await store.run(store.load_recent, 'reports', RECENT_HISTORY))
+        self.completed_reviews.extend(await store.run(store.load_recent, 'reviews', RECENT_HISTORY))
+
+        store.start()
+        logger.info("Loaded %d banned regexes, %d banned posters and %d banned reporters.",
+                    len(self.regexes_to_ban), len(self.offenders.banned_posters), len(self.offenders.banned_reporters))
+
+    async def write_metrics_periodically(self):
+        while True:
+            await asyncio.sleep(METRICS_WRITE_INTERVAL)
+            self.update_metric_gauges()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.metrics.write_prometheus, self.metrics_file)
+            except OSError as e:
+                logger.warning("Failed to write metrics: %s", e)
+
+    def update_metric_gauges(self):
+        for name, value in self.verdict_cache.stats().items():
+            self.metrics.set_gauge(f"verdict_cache_{name}", value)
+        for name, value in self.message_cache.stats().items():
+            self.metrics.set_gauge(f"message_cache_{name}", value)
+        self.metrics.set_gauge("inprogress_reports", len(self.inprogress_reports))
+        self.metrics.set_gauge("inprogress_reviews", len(self.inprogress_reviews))
+        for name, value in self.review_queue.stats().items():
+            self.metrics.set_gauge(f"review_queue_{name}", value)
+        self.metrics.set_gauge("banned_regexes", len(self.regexes_to_ban))
+        if self.spam_bursts:
+            for name, value in self.spam_bursts.stats().items():
+                self.metrics.set_gauge(f"spam_burst_{name}", value)
+        self.metrics.set_gauge("openai_circuit_open", int(self.openai_breaker.is_open()))
+
+    def format_stats(self):
+        self.update_metric_gauges()
+        text = self.metrics.format_text()
+        # Discord messages are limited to 2000 characters.
+        if len(text) > 1900:
+            text = text[:1900] + "\n..."
+        return "```\n" + text + "\n```"
+
+    async def close(self):
+        if self.metrics_task:
+            self.metrics_task.cancel()
+        await self.outbound.close()
+        if self.local_pool:
+            self.local_pool.close()
+        await self.review_log.close()
+        await self.verdict_cache.close()
+        if self.state_store:
+            await self.state_store.close()
+        await super().close()
 
     async def on_ready(self):
         print(f'{self.user.name} has connected to Discord! It is these guilds:')
@@ -90,6 +261,11 @@ class ModBot(discord.Client):
         This function is called whenever a message is sent in a channel that the bot can see (including DMs). 
         Currently the bot is configured to only handle messages that are sent over DMs or in your group's "group-#" channel. 
         '''
+        # Remember messages in our channels (including the bot's own reports in the mod channel) for link lookups.
+        if message.guild and message.channel.name in (f'group-{self.group_num}', f'group-{self.group_num}-mod'):
+            self.message_cache.add(message)
+            self.content_hashes.record(message.id, message.content)
+
         # Ignore messages from the bot 
         if message.author.id == self.user.id:
             return
@@ -120,15 +296,19 @@ class ModBot(discord.Client):
             print()
 
             print("BANNED DUE TO FALSE REPORTS ----------------------")
-            for id in self.banned_reporters:
+            for id in self.offenders.banned_reporters:
                 print(id)
             print()
 
             print("BANNED DUE TO CONTENT ----------------------------")
-            for id in self.banned_posters:
+            for id in self.offenders.banned_posters:
                 print(id)
             print()
 
+            print("VERDICT CACHE ----------------------------------")
+            print(self.verdict_cache.stats())
+            print()
+
             await message.delete()
             return
 
@@ -139,29 +319,77 @@ class ModBot(discord.Client):
             await self.handle_dm(message)
 
     async def on_message_edit(self, before, after):
-        print(f"{before.author.name} edited a previously sent message.")
-        print(f"The old message: '{before.content}'")
-        print(f"The new message: '{after.content}'\n")
+        trace_logger.debug("%s edited a previously sent message. The old message: '%s'. The new message: '%s'",
+                           before.author.name, before.content, after.content)
+        # Embeds unfurling and pins are edits too. Only send the message through moderation again if its text changed.
+        if not self.content_hashes.changed(after.id, after.content, before.content):
+            self.metrics.increment("edits_unchanged")
+            return
+        self.metrics.increment("edits_rescored")
+        # on_message also replaces the cached copy and the hash with the edited message.
         await self.on_message(after)
+
+    async def on_raw_message_delete(self, payload):
+        self.message_cache.remove(payload.message_id)
+        self.content_hashes.remove(payload.message_id)
+
+    async def on_raw_bulk_message_delete(self, payload):
+        # Our own bulk deletes (see outbound.py) only fire this event, not on_raw_message_delete.
+        for message_id in payload.message_ids:
+            self.message_cache.remove(message_id)
+            self.content_hashes.remove(message_id)
+
+    async def resolve_message(self, channel, message_id):
+        '''
+        Returns the message with this ID in `channel`, from the message cache if we've seen it and otherwise
+        from Discord. Raises discord.errors.NotFound like channel.fetch_message if it doesn't exist.
+        '''
+        message = self.message_cache.get(message_id)
+        if message is not None and message.channel.id == channel.id:
+            return message
+        with self.metrics.timer("discord_fetch"):
+            message = await channel.fetch_message(message_id)
+        self.message_cache.add(message)
+        return message
         
     async def handle_dm(self, message):
-        print(f"The discord bot has detected a new dm from {message.author.name}")
-        print(f"The message content: '{message.content}' \n")
+        trace_logger.debug("The discord bot has detected a new dm from %s. The message content: '%s'",
+                           message.author.name, message.content)
 
         await self.report_flow(message)
 
     async def handle_channel_message(self, message):
-        print(f"The discord bot has detected a new message from {message.author.name} in {message.guild.name}")
-        print(f"The message content: '{message.content}' \n")
+        with self.metrics.timer("handle_channel_message"):
+            await self.handle_channel_message_untimed(message)
+
+    async def handle_channel_message_untimed(self, message):
+        trace_logger.debug("The discord bot has detected a new message from %s in %s. The message content: '%s'",
+                           message.author.name, message.guild.name, message.content)
+        self.metrics.increment("channel_messages")
+
+        # Flooding is dealt with before anything expensive runs. Mods and the mod channel aren't limited.
+        admission = None
+        if self.flood_control and message.channel.name == f'group-{self.group_num}' and message.author.id not in self.mods:
+            admission = self.flood_control.check(message.author.id, message.channel.id)
+            if admission == FLOOD_DELETE:
+                self.metrics.increment("flood_deleted")
+                await self.outbound.delete(message)
+                if self.flood_control.should_warn(message.author.id):
+                    self.outbound.notify(message.channel, f"{message.author.name} is posting too fast. Their messages are deleted until they slow down.")
+                return
+            if admission == LOCAL_ONLY:
+                self.metrics.increment("flood_local_only")
 
-        if message.author.id in self.banned_posters:
-            await message.delete()
-            await message.channel.send(f"{message.author.name} is banned due to violating content policies.")
+        if self.offenders.is_banned_poster(message.author.id):
+            self.metrics.increment("banned_user_messages")
+            await self.outbound.delete(message)
+            self.outbound.notify(message.channel, f"{message.author.name} is banned due to violating content policies.")
             return
 
-        if message.author.id in self.banned_reporters:
-            await message.delete()
-            await message.channel.send(f"{message.author.name} is banned due to making false reports.")
+        if self.offenders.is_banned_reporter(message.author.id):
+            self.metrics.increment("banned_user_messages")
+            await self.outbound.delete(message)
+            self.outbound.notify(message.channel, f"{message.author.name} is banned due to making false reports.")
             return
 
         # Anyone can post within this channel. Note that messages in this channel can be 
@@ -169,13 +397,16 @@ class ModBot(discord.Client):
         # to the moderator channel for review.
         if message.channel.name == f'group-{self.group_num}':
 
-            for banned_regex in self.regexes_to_ban:
-                if re.fullmatch(banned_regex, message.content):
-                    await message.channel.send(f"{message.content} is not allowed. It matches a banned regex.\n")
-                    await message.delete()
-                    return
+            with self.metrics.timer("ban_regex"):
+                banned_regex = self.regexes_to_ban.match(message.content)
+            if banned_regex is not None:
+                logger.info("Message from %s matches the banned regex '%s'", message.author.name, banned_regex)
+                self.metrics.increment("banned_regex_matches")
+                await self.outbound.delete(message)
+                self.outbound.notify(message.channel, f"{message.content} is not allowed. It matches a banned regex.\n")
+                return
 
-            await self.automatic_detection_flow(message)
+            await self.automatic_detection_flow(message, local_only=admission == LOCAL_ONLY)
             await self.report_flow(message)
         
         # Only mods can post within this channel. Note that besides the messages posted by mods,
@@ -190,28 +421,25 @@ class ModBot(discord.Client):
             #     return
 
 
+            if message.content == "stats":
+                await self.timed_send(message.channel, self.format_stats())
+                return
+
             # Mods are able to ban regex words by specifying: BAN: SOMETHING
             if message.content.startswith("BAN:"):
                 regex_to_ban = message.content[4:]
 
                 try:
-                    pattern = re.compile(regex_to_ban)
-                    self.regexes_to_ban.append(pattern)
+                    self.regexes_to_ban.add(regex_to_ban)
+                    if self.state_store:
+                        self.state_store.add_ban_rule(regex_to_ban)
                     reply =  f"The regex '{regex_to_ban}' is no longer allowed on the server.\n"
-                    await message.channel.send(reply)
+                    await self.timed_send(message.channel, reply)
                 except re.error:
-                    await message.channel.send("Malformated regex")
+                    await self.timed_send(message.channel, "Malformated regex")
                 return
             
             await self.review_flow(message)
-            
-            # If a review process was completed, we can detect a user making false reports.
-            # (user has made several reports, which all have been deemed as not breaking content policies)
-            self.check_false_reports()
-
-            # If a review process was compelted, we can detect a user with multiple reports against him
-            # (user has repeatedly posted content which have been deemed to break content policies).
-            self.check_past_violations()
 
     async def review_flow(self, message):
         ''''
@@ -221,85 +449,95 @@ class ModBot(discord.Client):
         # Handle a help message
         if message.content == Review.HELP_KEYWORD:
             reply =  "Use the `review` command to begin the review process.\n"
+            reply += "Use the `next` command to review the most urgent report that nobody has picked up yet.\n"
             reply += "Use the `cancel` command to cancel the review process.\n"
-            await message.channel.send(reply)
+            reply += "Use the `stats` command to see how long each moderation stage takes.\n"
+            await self.timed_send(message.channel, reply)
             return
     
         author_id = message.author.id
         responses = []
 
         # Only respond to messages if they're part of a review flow
-        if author_id not in self.inprogress_reviews and not message.content.startswith(Review.START_KEYWORD):
+        if author_id not in self.inprogress_reviews and not (message.content.startswith(Review.START_KEYWORD) or message.content == Review.NEXT_KEYWORD):
             return
 
         # If we don't currently have an active review for this user, add one
         if author_id not in self.inprogress_reviews:
-            self.inprogress_reviews[author_id] = Review(self)
+            self.inprogress_reviews[author_id] = Review(self, author_id)
 
         # Let the moderator class handle this message; forward all the messages it returns to us
-        responses = await self.inprogress_reviews[author_id].handle_message(message)
-
-        if self.inprogress_reviews[author_id].review_complete():
-            review_information = self.inprogress_reviews[author_id].get_review_information()
-            review_flow = review_information['metadata']
+        review = self.inprogress_reviews[author_id]
+        responses = await review.handle_message(message)
 
+        if review.review_complete():
             self.inprogress_reviews.pop(author_id)
-            await message.channel.send(review_flow) 
+
+            # Nothing was picked for review (`next` with an empty queue, or cancelled before pasting a link).
+            if review.message_info is None:
+                for r in responses:
+                    await self.timed_send(message.channel, r)
+                return
+
+            # If the moderator's claim ran out and someone else picked the report up, only one review may count.
+            if review.queue_id and 'Review canceled' not in review.review_flow_to_string():
+                item = self.review_queue.complete(review.queue_id, author_id)
+                if item is None:
+                    await self.timed_send(message.channel, "Your claim on this report ran out and another moderator picked it up, so this review was not recorded.")
+                    return
+                self.metrics.observe("review_wait", time.monotonic() - item.created, WAIT_BUCKETS)
+
+            review_information = review.get_review_information()
+            review_flow = review_information['metadata']
+            await self.timed_send(message.channel, review_flow) 
 
             # If review was canceled, then we don't need to update anything.
             if 'Review canceled' in review_flow:
+                # Hand the report back so someone else can pick it up.
+                if review.queue_id:
+                    self.review_queue.release(review.queue_id, author_id)
                 return
 
             self.completed_reviews.append(review_information)
+            if self.state_store:
+                self.state_store.add_review(review_information)
+
+            # Now that the review is completed, we can detect a user making false reports
+            # (user has made several reports, which all have been deemed as not breaking content policies)
+            # or a user who has repeatedly posted content which have been deemed to break content policies.
+            for user_id, reason in self.offenders.record_review(review_information):
+                if reason == BANNED_POSTER:
+                    logger.info("%s has made %d+ posts that violated content policies. They are banned.", user_id, self.offenders.violation_threshold)
+                else:
+                    logger.info("%s has made %d+ false reports. They are banned.", user_id, self.offenders.false_report_threshold)
+                if self.state_store:
+                    self.state_store.add_ban(user_id, reason)
 
             # Add the completed review to the log for later analysis.
-            log_file = open(logging_path, "a")
-            log_file.write(f"{review_information['reporter']}|{review_information['author']}|{review_information['message']}|{review_information['violated']}\n")
-            log_file.close()
+            self.review_log.write(review_information)
         else: 
+            # The moderator is still working on it, keep their claim on the report.
+            if review.queue_id:
+                self.review_queue.renew(review.queue_id, author_id)
             for r in responses:
-                await message.channel.send(r)
+                await self.timed_send(message.channel, r)
 
-    def check_false_reports(self):
-        ''''
-        Users who have made 3+ false reports need to be banned from the server. 
+    async def timed_send(self, channel, text):
         '''
-        user_id_to_false_reports = {}
-        for review in self.completed_reviews:
-            if not review['violated']:
-                reporter_id = review['reporter']
-
-                if reporter_id not in user_id_to_false_reports:
-                    user_id_to_false_reports[reporter_id] = 0
-
-                user_id_to_false_reports[reporter_id] += 1
-
-        for user_id in user_id_to_false_reports:
-            if user_id_to_false_reports[user_id] >= 3:
-                if user_id not in self.banned_reporters:
-                    self.banned_reporters.append(int(user_id))
-                    print(f"{user_id} has made 3+ false reports. They are banned.\n")
-
-    def check_past_violations(self):
-        ''''
-        Users who have made 3+ posts that violated content policies need to be banned from the server.
+        channel.send, timed as discord_send like the sends in outbound.py, for replies in the report and review flows.
         '''
-        user_id_to_true_reports = {}
-        for review in self.completed_reviews:
-            if review['violated']:
-                author_id = review['author']
-
-                if author_id not in user_id_to_true_reports:
-                    user_id_to_true_reports[author_id] = 0
-
-                user_id_to_true_reports[author_id] += 1
-
-        for user_id in user_id_to_true_reports:
-            if user_id_to_true_reports[user_id] >= 3:
-                if user_id not in self.banned_posters:
-                    self.banned_posters.append(int(user_id))
-                    print(f"{user_id} has made 3+ posts that violated content policies. They are banned.\n")
+        with self.metrics.timer("discord_send"):
+            return await channel.send(text)
 
+    def queue_for_review(self, mod_message, report, position=None):
+        '''
+        Adds a report that was just posted to the mod channel (as `mod_message`) to the review queue. The report
+        is stored the way Review would read it back from the mod message, so reviews look the same either way.
+        Reports in a digest message are queued by (message ID, position) and can only be reviewed with `next`.
+        '''
+        info = OrderedDict((key, str(value)) for key, value in report.items())
+        queue_id = mod_message.id if position is None else (mod_message.id, position)
+        self.review_queue.add(queue_id, info, report.get('priority'))
 
     async def report_flow(self, message):
         ''''
@@ -310,7 +548,7 @@ class ModBot(discord.Client):
         if message.content == Report.HELP_KEYWORD:
             reply =  "Use the `report` command to begin the reporting process.\n"
             reply += "Use the `cancel` command to cancel the report process.\n"
-            await message.channel.send(reply)
+            await self.timed_send(message.channel, reply)
             return
 
         author_id = message.author.id
@@ -327,7 +565,7 @@ class ModBot(discord.Client):
         # Let the report class handle this message; forward all the messages it returns to us
         responses = await self.inprogress_reports[author_id].handle_message(message)
         for r in responses:
-            await message.channel.send(r)
+            await self.timed_send(message.channel, r)
 
         # If the report is complete or cancelled, remove it from our map
         if self.inprogress_reports[author_id].report_complete():
@@ -336,12 +574,17 @@ class ModBot(discord.Client):
             if not self.inprogress_reports[author_id].report_was_canceled():
                 report_information = self.inprogress_reports[author_id].get_report_information()
                 self.completed_reports.append(report_information)
+                if self.state_store:
+                    self.state_store.add_report(report_information)
             
             self.inprogress_reports.pop(author_id)
 
     async def auto_delete_message(self, message):
-        await message.delete()
-        await message.channel.send(f'Deleted offensive message from {message.author.name}. Please be respectful for community guidelines.')
+        self.metrics.increment("auto_deleted")
+        self.message_cache.remove(message.id)
+        await self.outbound.delete(message)
+        self.outbound.notify(message.channel, f'Deleted offensive message from {message.author.name}. Please be respectful for community guidelines.')
+
     async def auto_report_message(self, message, metadata):
         mod_channel = self.mod_channels[message.guild.id]
         mod_message = OrderedDict()
@@ -351,92 +594,197 @@ class ModBot(discord.Client):
         mod_message['message'] = message.content
         mod_message['link'] = message.jump_url
         mod_message['metadata'] = metadata
-        await mod_channel.send(formatter.format_dict_to_str(mod_message))
+        self.metrics.increment("auto_reported")
+        sent, position = await self.outbound.send_report(mod_channel, formatter.format_dict_to_str(mod_message))
+        self.queue_for_review(sent, mod_message, position)
 
-    async def automatic_detection_flow(self, message):
+    async def automatic_detection_flow(self, message, local_only=False):
         ''''
         Flow responsible for detecting harmful messages (automatically).
         '''
-        # TODO: Cleanup profanity score codings if no longer needed. 
+        cluster, is_leader, exact = None, True, True
+        if self.spam_bursts:
+            cluster, is_leader, exact = self.spam_bursts.observe(message.guild.id, message.content, message.author.id)
+
+        # Near-duplicates of a message we're scoring (or just scored) get the same action without being scored again.
+        if not is_leader:
+            verdict = await cluster.wait_for_verdict()
+            # If scoring the first copy failed, this copy is scored on its own. Clean verdicts only carry over to
+            # exact copies, otherwise a clean message with a threat added to the end would never be scored.
+            if verdict is not None and (verdict[0] is not None or exact):
+                self.metrics.increment("spam_burst_copies")
+                await self.apply_burst_verdict(message, cluster, verdict)
+                return
 
-        if self.use_openai:
-            exception_occured = False
-            try:
-                openai_scores = openai_utils.get_openai_dict_scores(message.content)
+        verdict = None
+        try:
+            verdict = await self.classify_message(message, local_only)
+        finally:
+            if is_leader and cluster is not None:
+                cluster.decide(verdict)
+        await self.apply_verdict(message, verdict)
+
+    async def classify_message(self, message, local_only=False):
+        '''
+        Scores a message and returns the verdict as (action, report metadata), where action is DELETE, REPORT or None.
+        With local_only, profanity_check decides even if OpenAI is on.
+        '''
+        if self.use_openai and not local_only:
+            local_score = None
+
+            # In cascade mode the cheap local classifier settles the clear cases, only the messages it is
+            # unsure about are sent to OpenAI.
+            if self.cascade:
+                local_score = await self.get_profanity_score_async(message.content)
+                if local_score < self.cascade_low:
+                    self.metrics.increment("cascade_local_clean")
+                    return (None, None)
+                if local_score > self.cascade_high:
+                    self.metrics.increment("cascade_local_delete")
+                    return (DELETE, None)
+                self.metrics.increment("cascade_openai")
+
+            # Verdicts OpenAI already gave are used even while the circuit is open.
+            openai_scores = self.cached_openai_scores(message.content)
+            local_task = None
+            if openai_scores is None and not self.openai_breaker.allow():
+                self.metrics.increment("openai_circuit_open_skips")
+            elif openai_scores is None:
+                if self.hedge and local_score is None:
+                    local_task = asyncio.create_task(self.get_profanity_score_async(message.content))
+                try:
+                    openai_scores = await asyncio.wait_for(self.get_openai_scores(message.content), self.openai_deadline)
+                except asyncio.CancelledError:
+                    # If this was the half-open trial, it may never reach OpenAI, so don't keep the circuit waiting on it.
+                    self.openai_breaker.release_trial()
+                    if local_task:
+                        local_task.cancel()
+                    raise
+                except asyncio.TimeoutError:
+                    logger.warning("OpenAI missed its %.1fs deadline. Resorting to backup systems.", self.openai_deadline)
+                    self.metrics.increment("openai_timeouts")
+                except Exception:
+                    logger.warning("OpenAI failed to generate a response. Resorting to backup systems.", exc_info=True)
+                    self.metrics.increment("openai_failures")
+
+            if openai_scores is not None:
+                if local_task:
+                    local_task.cancel()
                 if (self.debug):
-                    await message.channel.send(f'Debugging Info: Message received as `{message.content}`. {self.openai_score_format(openai_scores)}')
-                # Number of categories that have a score of at least 4 (scale 1-5)
-                score_at_least_4_count = sum(1 for value in openai_scores.values() if value >= 4)
-
-                message_auto_reported = False
-                message_auto_deleted = False
-
-                if (score_at_least_4_count >=2):
-                    message_auto_deleted = True
-                    await self.auto_delete_message(message)
-                elif (score_at_least_4_count >= 1):
-                    message_auto_reported = True
-                    await self.auto_report_message(message, self.openai_score_format(openai_scores))
-            
-            except:
-                print("OpenAI failed to generate a response. Resorting to backup systems.\n")
-                exception_occured = True
+                    await self.timed_send(message.channel, f'Debugging Info: Message received as `{message.content}`. {self.openai_score_format(openai_scores)}')
+                return self.openai_verdict(openai_scores)
 
             # If an error occured with openAI, then go ahead and do the backup checks.
-            if exception_occured:
-            # if exception_occured or (not message_auto_deleted and not message_auto_reported):
-                scores = self.get_profanity_score(self.sanitize_malicious_input(message.content))
-
-                # Blatantly harmful messages don't need to be reviewed. "fuck you" is an example of such a message.
-                if (scores > 0.95):
-                    await self.auto_delete_message(message)
+            if local_task:
+                local_score = await local_task
+            elif local_score is None:
+                local_score = await self.get_profanity_score_async(message.content)
+            return self.profanity_verdict(local_score)
 
-                # Ambigious messages need to be reviewed. "I hate that" is an example of such a message.
-                elif (scores > 0.4):
-                    await self.auto_report_message(message, self.profanity_score_format("{:.2f}".format(scores)))
-        
         # Do not get rid of this else statement. Worse case scenario, ChatGPT isn't working on the demo day, 
         # so we are able to turn off the openAI flag and use the checks below for malicious spacing or intentional misspellings.
         else:
-            scores = self.get_profanity_score(self.sanitize_malicious_input(message.content))
-
-            # Blatantly harmful messages don't need to be reviewed. "fuck you" is an example of such a message.
-            if (scores > 0.95):
-                await self.auto_delete_message(message)
-
-            # Ambigious messages need to be reviewed. "I hate that" is an example of such a message.
-            elif (scores > 0.4):
-                await self.auto_report_message(message, self.profanity_score_format("{:.2f}".format(scores)))
-
-    def sanitize_malicious_input(self, raw_message):
+            scores = await self.get_profanity_score_async(message.content)
+            return self.profanity_verdict(scores)
+
+    def openai_verdict(self, openai_scores):
+        # Number of categories that have a score of at least 4 (scale 1-5)
+        score_at_least_4_count = sum(1 for value in openai_scores.values() if value >= 4)
+
+        if (score_at_least_4_count >=2):
+            return (DELETE, None)
+        elif (score_at_least_4_count >= 1):
+            return (REPORT, self.openai_score_format(openai_scores))
+        return (None, None)
+
+    def profanity_verdict(self, scores):
+        # Blatantly harmful messages don't need to be reviewed. "fuck you" is an example of such a message.
+        if (scores > PROFANITY_DELETE_THRESHOLD):
+            return (DELETE, None)
+
+        # Ambigious messages need to be reviewed. "I hate that" is an example of such a message.
+        elif (scores > PROFANITY_REPORT_THRESHOLD):
+            return (REPORT, self.profanity_score_format("{:.2f}".format(scores)))
+        return (None, None)
+
+    async def apply_verdict(self, message, verdict):
+        action, metadata = verdict
+        if action == DELETE:
+            await self.auto_delete_message(message)
+        elif action == REPORT:
+            await self.auto_report_message(message, metadata)
+
+    async def apply_burst_verdict(self, message, cluster, verdict):
         '''
-        There are alot of ways that people can bypass automatic detection. This is an attempt to limit some of those
-        ways. For example, people can intentionally mispell words, add random spacing between characters, etc...
+        Copies are deleted like the first message was, but reports aren't repeated for every copy. Once the
+        cluster is big enough to be a burst, the mod channel gets one report about the whole cluster.
         '''
+        action, metadata = verdict
+        if action == DELETE:
+            await self.auto_delete_message(message)
+        elif action == REPORT and not cluster.reported and cluster.count >= SPAM_BURST_REPORT_SIZE:
+            cluster.reported = True
+            self.metrics.increment("spam_burst_reports")
+            burst = f"Spam burst: {cluster.count} near-identical messages from {len(cluster.authors)} users so far. {metadata}"
+            await self.auto_report_message(message, burst)
+
+    def openai_cache_key(self, text):
+        # Keyed on the text itself, not the sanitized text: sanitizing maps different messages to the same
+        # banned word ("hello" -> "hell"), and OpenAI scores the original text anyway.
+        return re.sub(r'\s+', ' ', text).strip()
+
+    def cached_openai_scores(self, text):
+        return self.verdict_cache.get("openai", self.openai_cache_key(text))
+
+    async def get_openai_scores(self, text):
+        '''
+        Asks OpenAI to score a message and caches the reply. Check cached_openai_scores first.
+        '''
+        with self.metrics.timer("openai"):
+            if self.openai_batcher:
+                openai_scores = await self.openai_batcher.submit(text)
+            else:
+                openai_scores = await openai_utils.get_openai_dict_scores_async(text)
 
-        # handle words with malicious spacing between -> 'f u   c k' = 'fuck'
-        raw_message_single_spaces = re.sub(' +', ' ', raw_message)
-
-        all_single_characters = True
-        for word in raw_message_single_spaces.split(" "):
-            if len(word) > 1:
-                all_single_characters = False
-
-        if all_single_characters:
-            raw_message_no_spaces = re.sub(' +', '', raw_message)
-            return raw_message_no_spaces
+        # Don't remember replies that are missing categories, they should be asked again.
+        if len(openai_scores) == openai_utils.NUM_CATEGORIES:
+            self.verdict_cache.put("openai", self.openai_cache_key(text), openai_scores)
+        return openai_scores
 
-        # handle words that are intentionally mispelled
-        for word in raw_message_single_spaces.split(" "):
-            for banned_word in banned_words:
-                if editdistance.eval(word, banned_word) <= 1:
-                    # fuk you man -> fuck -> triggers automatic detection of sentence
-                    return banned_word
+    def sanitize_malicious_input(self, raw_message):
+        # See local_scoring.sanitize, it lives there so worker processes can run it too.
+        with self.metrics.timer("sanitize"):
+            return local_scoring.sanitize(raw_message)
 
-        return raw_message
+    async def get_profanity_score_async(self, raw_message):
+        '''
+        Sanitizes and scores a message with profanity_check. Includes the time spent waiting for the batch to fill up.
+        '''
+        with self.metrics.timer("profanity_score"):
+            return await self.profanity_batcher.submit(raw_message)
 
-    def get_profanity_score(self, message):
-        return profanity_check.predict_prob([message])[0]
+    async def score_profanity_batch(self, raw_messages):
+        '''
+        Sanitizes and scores a batch of messages with a single profanity_check call, in the worker pool if
+        there is one. Messages we already have a verdict for are taken from the cache, so only the rest go
+        through the vectorizer and model.
+        '''
+        scores = [self.verdict_cache.get("local", message) for message in raw_messages]
+        missing = [raw_messages[i] for i, score in enumerate(scores) if score is None]
+        if missing:
+            if self.local_pool:
+                with self.metrics.timer("local_pool_batch"):
+                    new_scores = await self.local_pool.sanitize_and_score(missing)
+            else:
+                sanitized = [self.sanitize_malicious_input(message) for message in missing]
+                with self.metrics.timer("profanity_check_batch"):
+                    new_scores = local_scoring.score(sanitized)
+            new_scores = iter(new_scores)
+            for i, score in enumerate(scores):
+                if score is None:
+                    scores[i] = next(new_scores)
+                    self.verdict_cache.put("local", raw_messages[i], scores[i])
+        return scores
 
     
     def openai_score_format(self, openai_dict):
@@ -447,16 +795,52 @@ class ModBot(discord.Client):
 
 
 def main(args):
-    print("OpenAI flag:", args.openai)
-    print("Debug flag:", args.openai)
-    client = ModBot(args.openai, args.debug)
-    client.run(discord_token)
+    log_listener = log_setup.setup_logging(args.log_levels, trace_sample_rate=args.trace_sample_rate)
+    logger.info("OpenAI flag: %s", args.openai)
+    logger.info("Debug flag: %s", args.debug)
+    openai_utils.configure(args.openai_concurrency, args.openai_timeout, args.openai_format)
+    client = ModBot(args.openai, args.debug, args.openai_batch_size, args.openai_batch_ms, args.cache_db,
+                    args.profanity_batch_size, args.profanity_batch_ms, args.false_report_threshold, args.violation_threshold,
+                    args.state_db, args.metrics_file, args.cascade, args.cascade_low, args.cascade_high,
+                    args.openai_deadline, args.hedge, args.spam_window, args.flood_user_limit, args.flood_channel_limit, args.flood_window,
+                    args.digest_reports, args.local_workers, args.openai_slow_call)
+    try:
+        # Logging is already set up, don't let discord.py add its own handler.
+        client.run(discord_token, log_handler=None)
+    finally:
+        log_listener.stop()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="discord bot args parser")
 
     parser.add_argument("-openai", "--openai", type=bool, help="If use OpenAI to automatically detect harmful messages")
     parser.add_argument("-debug", "--debug", type=bool, help="If use debugging mode. It will send additional messages in Discord")
+    parser.add_argument("-cascade", "--cascade", type=bool, help="With OpenAI, only send messages that profanity_check is unsure about to OpenAI")
+    parser.add_argument("-cascade_low", "--cascade_low", type=float, default=0.1, help="profanity_check score below which a message counts as clean in cascade mode")
+    parser.add_argument("-cascade_high", "--cascade_high", type=float, default=PROFANITY_DELETE_THRESHOLD, help="profanity_check score above which a message is deleted without asking OpenAI in cascade mode")
+    parser.add_argument("-openai_deadline", "--openai_deadline", type=float, default=5.0, help="Seconds a message waits for OpenAI before profanity_check decides instead")
+    parser.add_argument("-openai_slow_call", "--openai_slow_call", type=float, default=2.0, help="OpenAI replies slower than this many seconds count towards opening the circuit breaker")
+    parser.add_argument("-hedge", "--hedge", type=bool, help="Run profanity_check alongside every OpenAI request so the fallback is ready immediately")
+    parser.add_argument("-openai_format", "--openai_format", type=str, default="text", choices=openai_utils.RESPONSE_FORMATS, help="How OpenAI replies: category lines (text) or a compact digits, json or function call reply")
+    parser.add_argument("-openai_concurrency", "--openai_concurrency", type=int, default=8, help="Maximum number of OpenAI requests in flight at the same time")
+    parser.add_argument("-openai_timeout", "--openai_timeout", type=float, default=15, help="Seconds to wait for a single OpenAI request before resorting to backup systems")
+    parser.add_argument("-openai_batch_size", "--openai_batch_size", type=int, default=1, help="Maximum number of messages scored in one OpenAI request (1 disables batching)")
+    parser.add_argument("-openai_batch_ms", "--openai_batch_ms", type=int, default=50, help="Milliseconds to wait for more messages before sending a partial batch to OpenAI")
+    parser.add_argument("-profanity_batch_size", "--profanity_batch_size", type=int, default=64, help="Maximum number of messages scored in one profanity_check call")
+    parser.add_argument("-profanity_batch_ms", "--profanity_batch_ms", type=int, default=5, help="Milliseconds to wait for more messages before scoring a partial profanity_check batch")
+    parser.add_argument("-local_workers", "--local_workers", type=int, default=0, help="Worker processes for sanitizing and profanity_check (0 runs them on the event loop)")
+    parser.add_argument("-false_report_threshold", "--false_report_threshold", type=int, default=3, help="Number of false reports after which a reporter is banned")
+    parser.add_argument("-violation_threshold", "--violation_threshold", type=int, default=3, help="Number of violating posts after which an author is banned")
+    parser.add_argument("-spam_window", "--spam_window", type=float, default=120, help="Seconds near-duplicate messages are grouped so only the first copy is scored (0 disables)")
+    parser.add_argument("-flood_window", "--flood_window", type=float, default=10, help="Seconds over which posting rates are counted for flood control (0 disables)")
+    parser.add_argument("-flood_user_limit", "--flood_user_limit", type=int, default=10, help="Messages a user may post per flood window before the rest are deleted (0 disables)")
+    parser.add_argument("-flood_channel_limit", "--flood_channel_limit", type=int, default=120, help="Messages per flood window after which the channel is only scored locally (0 disables)")
+    parser.add_argument("-digest_reports", "--digest_reports", type=bool, help="Merge automatic reports that arrive together into digest messages in the mod channel (review them with `next`)")
+    parser.add_argument("-state_db", "--state_db", type=str, default=state_db_path, help="SQLite file that keeps reports, reviews and bans between restarts (empty to disable)")
+    parser.add_argument("-metrics_file", "--metrics_file", type=str, default=metrics_path, help="Prometheus text file the bot's metrics are written to (empty to disable)")
+    parser.add_argument("-log_levels", "--log_levels", type=str, default=log_setup.DEFAULT_LEVELS, help="Log level per subsystem, like discord=INFO,modbot.openai=DEBUG")
+    parser.add_argument("-trace_sample_rate", "--trace_sample_rate", type=float, default=0.01, help="Fraction of per-message traces that are logged")
+    parser.add_argument("-cache_db", "--cache_db", type=str, help="SQLite file to keep classifier verdicts in between runs")
 
     args = parser.parse_args()
     main(args)
\ No newline at end of file
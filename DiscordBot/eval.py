@@ -1,56 +1,140 @@
-import openai_utils
+# Scores CSV datasets with OpenAI. For every input file, writes a copy where each row is followed by its
+# 9 category scores. Example:
+#   python3 eval.py harassment.csv edge.csv not.csv=output.csv
+# Rows are scored concurrently under a rate limit. Finished rows are checkpointed to `<output>.ckpt.jsonl`,
+# so an interrupted run picks up where it stopped and a finished file is not scored again.
+
+import argparse
+import asyncio
 import csv
+import json
+import os
 import time
-# Function that takes a value and returns a dictionary
-def process_value(value):
-    # Your logic to process the value and return a dictionary
-    # For demonstration, let's assume the value is a string and return a dictionary with fixed values
-    return openai_utils.get_openai_dict_scores(value)
-
-# Path to the input CSV file
-input_file = "harassment.csv"
-
-# Path to the output CSV file
-output_file = "harassment-output.csv"
-
-# Open input and output files
-with open(input_file, "r") as csv_input, open(output_file, "w", newline="") as csv_output:
-    reader = csv.reader(csv_input)
-    writer = csv.writer(csv_output)
-
-    # Read the header row
-    header = next(reader)
-
-    # Process the header value and get the dictionary keys
-    header_value = header[0]
-    # header_dict = process_value(header_value)
-    # print(header_dict)
-    # assert len(header_dict.keys()) == 9
-    # keys = list(header_dict.keys())
-
-    # Extend the header row with the dictionary keys
-    # header.extend(keys)
-    writer.writerow(header)
-
-    # Process each row and append the dictionary values to the row
-    count = 0
-    for row in reader:
-        value = row[0]
+
+import openai_utils
+from rate_limit import TokenBucket, backoff_delay
+from verdict_cache import VerdictCache
+
+# Scores from previous runs are kept on disk, so rerunning the evaluation only asks OpenAI about new rows.
+cache = VerdictCache(ttl_seconds=None, db_path="data/verdicts.sqlite")
+
+
+def output_path_for(input_path):
+    stem, ext = os.path.splitext(input_path)
+    return f"{stem}-output{ext}"
+
+
+def load_checkpoint(path):
+    '''
+    Map from row number to its checkpoint record. The last line may be incomplete if the run was killed.
+    '''
+    done = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                done[record['row']] = record
+    return done
+
+
+async def score_row(text, bucket, args):
+    '''
+    Returns (scores, seconds the successful request took, or None when cached). Retries failures and
+    replies with missing categories (or, with a compact format, replies that don't parse) with exponential
+    backoff; returns (None, None) once out of attempts.
+    '''
+    row_dict = cache.get("openai", text)
+    if row_dict is not None:
+        return list(row_dict.values()), None
+
+    for attempt in range(args.attempts):
+        await bucket.acquire()
+        start = time.time()
         try:
-            row_dict = process_value(value)
-        except:
-            print("Error")
-            time.sleep(5)
-            continue
-        if (len(row_dict.keys()) != 9):
-            row_dict = process_value(value)
-            if (len(row_dict.keys()) != 9):
-                print("Skipping...")
-                continue
-        # Create a new row by appending the dictionary values
-        new_row = row + [row_dict[key] for key in row_dict.keys()]
-        writer.writerow(new_row)
-        count += 1
-        time.sleep(1)
-        print("processing.." + str(count))
-print("CSV processing completed!")
\ No newline at end of file
+            row_dict = await openai_utils.get_openai_dict_scores_async(text, timeout=args.timeout)
+        except Exception as e:
+            print(f"Error ({type(e).__name__}: {e}), retrying...")
+            row_dict = None
+        latency = time.time() - start
+
+        if row_dict is not None and len(row_dict) == openai_utils.NUM_CATEGORIES:
+            cache.put("openai", text, row_dict)
+            return list(row_dict.values()), latency
+        if attempt + 1 < args.attempts:
+            await asyncio.sleep(backoff_delay(attempt))
+    return None, None
+
+
+async def process_file(input_path, output_path, bucket, args):
+    with open(input_path, "r") as csv_input:
+        reader = csv.reader(csv_input)
+        header = next(reader)
+        rows = list(reader)
+
+    checkpoint_path = output_path + ".ckpt.jsonl"
+    done = load_checkpoint(checkpoint_path)
+    # A checkpoint entry only counts if the row still has the same text.
+    todo = [i for i, row in enumerate(rows) if i not in done or done[i]['text'] != row[0]]
+    print(f"{input_path}: {len(rows) - len(todo)} rows already scored, {len(todo)} to go")
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    count = 0
+    with open(checkpoint_path, "a") as checkpoint:
+
+        async def run(i):
+            nonlocal count
+            async with semaphore:
+                scores, latency = await score_row(rows[i][0], bucket, args)
+            if scores is None:
+                print(f"Skipping row {i + 1}...")
+                return
+            record = {'row': i, 'text': rows[i][0], 'scores': scores, 'latency': latency}
+            checkpoint.write(json.dumps(record) + "\n")
+            checkpoint.flush()
+            done[i] = record
+            count += 1
+            if count % 10 == 0:
+                print(f"processing.. {count}/{len(todo)}")
+
+        await asyncio.gather(*(run(i) for i in todo))
+
+    # Write the output in input order. Rows that couldn't be scored are left out, like before.
+    with open(output_path, "w", newline="") as csv_output:
+        writer = csv.writer(csv_output)
+        writer.writerow(header)
+        for i, row in enumerate(rows):
+            if i in done:
+                writer.writerow(row + done[i]['scores'])
+    print(f"{input_path}: wrote {output_path}")
+
+
+async def main(args):
+    openai_utils.configure(args.concurrency, args.timeout, args.format)
+    bucket = TokenBucket(args.rpm / 60, capacity=args.concurrency)
+    cache.start()
+
+    start = time.time()
+    for item in args.inputs:
+        input_path, _, output_path = item.partition("=")
+        await process_file(input_path, output_path or output_path_for(input_path), bucket, args)
+
+    print("CSV processing completed!")
+    print(f"Took {time.time() - start:.1f} seconds")
+    print("Verdict cache:", cache.stats())
+    await cache.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="scores CSV datasets with OpenAI")
+    parser.add_argument("inputs", nargs="*", default=["harassment.csv"], help="Input CSV files, optionally as input.csv=output.csv")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum number of requests in flight")
+    parser.add_argument("--rpm", type=float, default=180, help="Maximum number of requests per minute")
+    parser.add_argument("--attempts", type=int, default=4, help="Attempts per row before it is skipped")
+    parser.add_argument("--format", default="text", choices=openai_utils.RESPONSE_FORMATS, help="How OpenAI replies, see openai_utils.RESPONSE_FORMATS")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for a single request")
+
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -0,0 +1,78 @@
+# Admission control for the moderated channel, so one flooding user (or a channel-wide flood) can't make
+# the bot score and answer every single message.
+
+import time
+
+# What to do with a message.
+ALLOW = "allow"
+LOCAL_ONLY = "local only" # Scored with profanity_check only, no OpenAI request
+DELETE = "delete"
+
+
+class SlidingWindowCounter:
+    '''
+    Approximate number of events per key in the last `window_seconds`, using O(1) memory and time per key.
+    Each key keeps the count of the current fixed window and of the window before it, and the earlier
+    count is weighted by how much of that window still overlaps the sliding window.
+    '''
+
+    def __init__(self, window_seconds):
+        self.window_seconds = window_seconds
+        self.counts = {} # Map from key to [window index, count in that window, count in the window before]
+        self.prune_at = 1024
+
+    def add(self, key, now=None):
+        '''
+        Counts an event for `key`. Returns the estimated number of events in the sliding window, including this one.
+        '''
+        now = time.monotonic() if now is None else now
+        position = now / self.window_seconds
+        index = int(position)
+
+        entry = self.counts.get(key)
+        if entry is None:
+            entry = self.counts[key] = [index, 0, 0]
+        elif entry[0] != index:
+            entry[2] = entry[1] if entry[0] == index - 1 else 0
+            entry[1] = 0
+            entry[0] = index
+        entry[1] += 1
+
+        if len(self.counts) > self.prune_at:
+            self.prune(index)
+        return entry[1] + entry[2] * (1 - (position - index))
+
+    def prune(self, index):
+        # Keys that haven't had an event in the last two windows count as zero anyway.
+        self.counts = {key: entry for key, entry in self.counts.items() if entry[0] >= index - 1}
+        self.prune_at = max(1024, 2 * len(self.counts))
+
+
+class FloodControl:
+    '''
+    Decides per message whether it goes through the full detection pipeline. Users posting more than
+    `user_limit` messages per `window_seconds` get their extra messages deleted without scoring. When the
+    whole channel goes over `channel_limit`, messages are only scored locally until the flood passes.
+    A limit of 0 turns that check off.
+    '''
+
+    def __init__(self, user_limit=10, channel_limit=120, window_seconds=10):
+        self.user_limit = user_limit
+        self.channel_limit = channel_limit
+        self.users = SlidingWindowCounter(window_seconds)
+        self.channels = SlidingWindowCounter(window_seconds)
+        self.warned = SlidingWindowCounter(window_seconds)
+
+    def check(self, user_id, channel_id):
+        now = time.monotonic()
+        if self.user_limit and self.users.add(user_id, now) > self.user_limit:
+            return DELETE
+        if self.channel_limit and self.channels.add(channel_id, now) > self.channel_limit:
+            return LOCAL_ONLY
+        return ALLOW
+
+    def should_warn(self, user_id):
+        '''
+        True for the first message of a flooding user in a window, so they are told once instead of every time.
+        '''
+        return self.warned.add(user_id) <= 1
@@ -0,0 +1,72 @@
+# Index for finding banned words that a message word is (almost) spelled like.
+
+from collections import defaultdict
+
+
+class BannedWordIndex:
+    '''
+    Symmetric-delete index over a list of banned words. Every banned word is stored under itself and
+    under each string you get by deleting one of its characters. Two words are within edit distance 1
+    only if they share one of those keys, so a lookup only has to check the handful of banned words
+    stored under the keys of the query word instead of the whole dictionary.
+    '''
+
+    def __init__(self, words=()):
+        self.words = set()
+        self.keys = defaultdict(set) # Map from a word or one of its deletes to the banned words that produce it
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        self.words.add(word)
+        for key in deletes(word):
+            self.keys[key].add(word)
+
+    def lookup(self, word):
+        '''
+        Returns a banned word within edit distance 1 of `word`, or None. An exact match is preferred,
+        otherwise the alphabetically first candidate is returned so the result doesn't depend on set order.
+        '''
+        if word in self.words:
+            return word
+
+        candidates = set()
+        for key in deletes(word):
+            candidates.update(self.keys.get(key, ()))
+
+        # Sharing a key is necessary but not sufficient (e.g. swapped letters share a key), so confirm.
+        matches = [candidate for candidate in candidates if within_one_edit(word, candidate)]
+        if matches:
+            return min(matches)
+        return None
+
+    def __len__(self):
+        return len(self.words)
+
+
+def deletes(word):
+    '''
+    The word itself plus every string obtained by deleting exactly one character.
+    '''
+    result = {word}
+    for i in range(len(word)):
+        result.add(word[:i] + word[i + 1:])
+    return result
+
+
+def within_one_edit(a, b):
+    '''
+    True if the Levenshtein distance between a and b is at most 1.
+    '''
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+
+    # Skip the common prefix, the rest must then be equal after one substitution, insertion or deletion.
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:]
+    return a[i:] == b[i + 1:]
@@ -0,0 +1,107 @@
+# The local (non-OpenAI) classifier: input sanitizing plus profanity_check. Everything here is a plain
+# module-level function so it can also run in worker processes, see LocalScoringPool.
+
+import asyncio
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import profanity_check
+
+from fuzzy_index import BannedWordIndex
+
+banned_words_path = 'data/badwords.txt'
+
+# Built on first use, in every process that scores messages.
+banned_words_index = None
+
+
+def load_banned_words(path=banned_words_path):
+    with open(path) as f:
+        banned_words = set()
+        for line in f:
+            banned_words.add(line.strip())
+    return banned_words
+
+
+def get_banned_words_index():
+    global banned_words_index
+    if banned_words_index is None:
+        banned_words_index = BannedWordIndex(load_banned_words(banned_words_path))
+    return banned_words_index
+
+
+def sanitize(raw_message):
+    '''
+    There are alot of ways that people can bypass automatic detection. This is an attempt to limit some of those
+    ways. For example, people can intentionally mispell words, add random spacing between characters, etc...
+    '''
+
+    # handle words with malicious spacing between -> 'f u   c k' = 'fuck'
+    raw_message_single_spaces = re.sub(' +', ' ', raw_message)
+
+    all_single_characters = True
+    for word in raw_message_single_spaces.split(" "):
+        if len(word) > 1:
+            all_single_characters = False
+
+    if all_single_characters:
+        raw_message_no_spaces = re.sub(' +', '', raw_message)
+        return raw_message_no_spaces
+
+    # handle words that are intentionally mispelled
+    index = get_banned_words_index()
+    for word in raw_message_single_spaces.split(" "):
+        banned_word = index.lookup(word)
+        if banned_word is not None:
+            # fuk you man -> fuck -> triggers automatic detection of sentence
+            return banned_word
+
+    return raw_message
+
+
+def score(sanitized_messages):
+    '''
+    profanity_check scores of already sanitized messages, vectorized in a single call.
+    '''
+    return [float(score) for score in profanity_check.predict_prob(sanitized_messages)]
+
+
+def sanitize_and_score(raw_messages):
+    return score([sanitize(message) for message in raw_messages])
+
+
+def warm_up():
+    '''
+    Loads everything scoring needs, so the first real message doesn't pay for it.
+    '''
+    get_banned_words_index()
+    score(["warm up"])
+
+
+class LocalScoringPool:
+    '''
+    Runs sanitize_and_score in `workers` separate processes, so scoring long messages doesn't hold up the
+    event loop and uses more than one core. Every worker has the banned words and the model loaded before
+    it gets its first message, and `start` waits until all of them are up.
+
+    Workers come from a forkserver rather than being forked from the bot, which by then has the event
+    loop and the OpenAI, cache and logging threads running.
+    '''
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver"),
+                                            initializer=warm_up)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        # Workers are only started when there is work for them, so give each one something to do.
+        await asyncio.gather(*(loop.run_in_executor(self.executor, os.getpid) for _ in range(self.workers)))
+
+    async def sanitize_and_score(self, raw_messages):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, sanitize_and_score, raw_messages)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
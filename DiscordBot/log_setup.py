@@ -0,0 +1,80 @@
+# Logging setup for the bot. Log calls only put the record on a queue; a background thread formats and
+# writes it, so the event loop never waits on file or console I/O.
+
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+# Levels used when nothing else is specified. Subsystems are logger names, e.g. "modbot.openai".
+DEFAULT_LEVELS = "discord=INFO,modbot=INFO,modbot.trace=DEBUG"
+
+# Logger for per-message traces ("detected a new message from ..."). Only a sample of them is kept.
+TRACE_LOGGER = "modbot.trace"
+
+
+class SampleFilter(logging.Filter):
+    '''
+    Lets through a random `rate` fraction of records. Warnings and errors always pass.
+    '''
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class ConsoleFilter(logging.Filter):
+    '''
+    Lets through the bot's own records, plus warnings and errors from any logger (discord, asyncio, ...).
+    '''
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or record.name == "modbot" or record.name.startswith("modbot.")
+
+
+def parse_levels(text):
+    '''
+    "discord=INFO,modbot.openai=DEBUG" -> {'discord': 'INFO', 'modbot.openai': 'DEBUG'}
+    '''
+    levels = {}
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        name, _, level = item.partition("=")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(levels=DEFAULT_LEVELS, log_file='discord.log', trace_sample_rate=0.01):
+    '''
+    Routes all logging through a queue to a listener thread that writes everything to `log_file` and
+    INFO and above from the bot, and warnings and errors from everything else, to the console. Returns the listener; call its stop() on shutdown
+    to flush what is still queued.
+    '''
+    log_queue = queue.Queue(-1)
+
+    file_handler = logging.FileHandler(filename=log_file, encoding='utf-8', mode='w')
+    file_handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(logging.INFO)
+    console_handler.addFilter(ConsoleFilter())
+    console_handler.setFormatter(logging.Formatter('%(message)s'))
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(logging.WARNING)
+
+    for name, level in {**parse_levels(DEFAULT_LEVELS), **parse_levels(levels)}.items():
+        logging.getLogger(name).setLevel(level)
+
+    # The filter sits on the logger, so dropped traces are never even put on the queue.
+    logging.getLogger(TRACE_LOGGER).addFilter(SampleFilter(trace_sample_rate))
+    return listener
@@ -0,0 +1,68 @@
+# Cache of recently seen messages, so message links can be resolved without a REST call.
+
+import hashlib
+from collections import OrderedDict
+
+
+class MessageCache:
+    '''
+    Bounded map from message ID to the discord.Message the bot received. Once `max_size` messages are cached
+    the least recently used one is dropped.
+    '''
+
+    def __init__(self, max_size=5000):
+        self.max_size = max_size
+        self.messages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, message):
+        self.messages[message.id] = message
+        self.messages.move_to_end(message.id)
+        while len(self.messages) > self.max_size:
+            self.messages.popitem(last=False)
+
+    def get(self, message_id):
+        message = self.messages.get(message_id)
+        if message is None:
+            self.misses += 1
+            return None
+        self.messages.move_to_end(message_id)
+        self.hits += 1
+        return message
+
+    def remove(self, message_id):
+        self.messages.pop(message_id, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.messages)}
+
+
+class ContentHashes:
+    '''
+    Bounded map from message ID to a hash of the text we last handled for it, so edits that don't change
+    the text (embeds unfurling, pins, ...) can be told apart from real edits.
+    '''
+
+    def __init__(self, max_size=50000):
+        self.max_size = max_size
+        self.hashes = OrderedDict()
+
+    def record(self, message_id, content):
+        self.hashes[message_id] = hashlib.blake2b(content.encode(), digest_size=8).digest()
+        self.hashes.move_to_end(message_id)
+        while len(self.hashes) > self.max_size:
+            self.hashes.popitem(last=False)
+
+    def remove(self, message_id):
+        self.hashes.pop(message_id, None)
+
+    def changed(self, message_id, content, previous_content=None):
+        '''
+        Whether `content` differs from what we last handled for this message. Messages we haven't seen are
+        compared against `previous_content` instead.
+        '''
+        seen = self.hashes.get(message_id)
+        if seen is None:
+            return content != previous_content
+        return seen != hashlib.blake2b(content.encode(), digest_size=8).digest()
@@ -0,0 +1,125 @@
+# Lightweight counters and latency histograms for the bot's hot paths.
+# Everything records into REGISTRY; the `stats` command in the mod channel shows it and it is also
+# written to a Prometheus text file.
+
+import os
+import time
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the latency histogram buckets. The last bucket catches everything else.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+# Buckets for things measured in minutes rather than milliseconds, like how long a report waits for review.
+WAIT_BUCKETS = (1.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0, 7200.0, 21600.0, 86400.0, float("inf"))
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+
+    def quantile(self, q):
+        '''
+        Upper bound of the bucket the q-th quantile falls in. Good enough to see where time goes.
+        '''
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = {} # Map from name to count
+        self.gauges = {} # Map from name to the last value set
+        self.histograms = {} # Map from name to Histogram of seconds
+
+    def increment(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, seconds, buckets=LATENCY_BUCKETS):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(buckets)
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        '''
+        Records how long the body takes into the `name` histogram. Works around awaits too.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def format_text(self):
+        lines = ["stage | count | mean | p50 | p95 | p99"]
+        for name, histogram in sorted(self.histograms.items()):
+            mean = histogram.sum / histogram.count if histogram.count else 0.0
+            lines.append(f"{name} | {histogram.count} | {format_seconds(mean)} | {format_seconds(histogram.quantile(0.5))} | "
+                         f"{format_seconds(histogram.quantile(0.95))} | {format_seconds(histogram.quantile(0.99))}")
+        if self.counters or self.gauges:
+            lines.append("")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name}: {value}")
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f"{name}: {value}")
+        return "\n".join(lines)
+
+    def format_prometheus(self, prefix="modbot"):
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {value}")
+        for name, histogram in sorted(self.histograms.items()):
+            metric = f"{prefix}_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{metric}_bucket{{le="{le}"}} {cumulative}')
+            lines.append(f"{metric}_sum {histogram.sum}")
+            lines.append(f"{metric}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # Write to a temporary file first so a scraper never reads half a file.
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.format_prometheus())
+        os.replace(tmp_path, path)
+
+
+def format_seconds(seconds):
+    if seconds == float("inf"):
+        return "inf"
+    if seconds < 1:
+        return f"{seconds * 1000:.1f}ms"
+    return f"{seconds:.2f}s"
+
+
+REGISTRY = Metrics()
@@ -0,0 +1,81 @@
+# Keeps track of users who keep making false reports or keep posting content that violates our policies.
+
+from collections import Counter
+
+# Reasons a user can be banned for
+BANNED_POSTER = "poster"
+BANNED_REPORTER = "reporter"
+
+
+class OffenderTracker:
+    '''
+    Counts false reports per reporter and violations per author as reviews complete, and bans users once
+    they reach the thresholds. Counters are updated in O(1) per review and bans are kept in sets, so
+    checking whether an author is banned doesn't depend on how many reviews have been done.
+    '''
+
+    def __init__(self, false_report_threshold=3, violation_threshold=3):
+        self.false_report_threshold = false_report_threshold
+        self.violation_threshold = violation_threshold
+
+        self.false_reports = Counter() # Map from reporter ID to number of reports that were not violations
+        self.violations = Counter() # Map from author ID to number of posts that were violations
+
+        self.banned_reporters = set() # All people banned due to making false reports
+        self.banned_posters = set() # All people banned due to violating content policies
+
+    def load(self, false_reports, violations, banned_reporters, banned_posters):
+        '''
+        Restores counters and bans saved from a previous run.
+        '''
+        for reporter_id, count in false_reports.items():
+            reporter_id = to_user_id(reporter_id)
+            if reporter_id is not None:
+                self.false_reports[reporter_id] += count
+        for author_id, count in violations.items():
+            author_id = to_user_id(author_id)
+            if author_id is not None:
+                self.violations[author_id] += count
+        self.banned_reporters.update(banned_reporters)
+        self.banned_posters.update(banned_posters)
+
+    def record_review(self, review):
+        '''
+        Updates the counters with a completed review. Returns a list of (user ID, BANNED_POSTER or BANNED_REPORTER)
+        for users who are newly banned because of it.
+        '''
+        newly_banned = []
+        if review['violated']:
+            author_id = to_user_id(review['author'])
+            if author_id is None:
+                return newly_banned
+            self.violations[author_id] += 1
+            if self.violations[author_id] >= self.violation_threshold and author_id not in self.banned_posters:
+                self.banned_posters.add(author_id)
+                newly_banned.append((author_id, BANNED_POSTER))
+        else:
+            # Automatic reports have "SYSTEM AUTOMATIC" as reporter, we don't ban the bot itself.
+            reporter_id = to_user_id(review['reporter'])
+            if reporter_id is None:
+                return newly_banned
+            self.false_reports[reporter_id] += 1
+            if self.false_reports[reporter_id] >= self.false_report_threshold and reporter_id not in self.banned_reporters:
+                self.banned_reporters.add(reporter_id)
+                newly_banned.append((reporter_id, BANNED_REPORTER))
+        return newly_banned
+
+    def is_banned_poster(self, user_id):
+        return user_id in self.banned_posters
+
+    def is_banned_reporter(self, user_id):
+        return user_id in self.banned_reporters
+
+
+def to_user_id(value):
+    '''
+    User IDs come back from the mod channel as strings. Returns the ID as an int, or None if it isn't a user ID.
+    '''
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
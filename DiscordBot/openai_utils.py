@@ -1,8 +1,48 @@
 import os
 import openai
 import json
+import logging
 from collections import OrderedDict
 import time
+import asyncio
+import re
+from concurrent.futures import ThreadPoolExecutor
+from metrics import REGISTRY as metrics
+
+logger = logging.getLogger('modbot.openai')
+
+# Maximum number of OpenAI requests that can be in flight at the same time from the async path.
+MAX_CONCURRENT_REQUESTS = 8
+# Seconds to wait for a single OpenAI request from the async path before giving up.
+REQUEST_TIMEOUT = 15
+
+# Categories OpenAI rates every message in, in the order of the prompts below.
+CATEGORIES = [
+    "Scam",
+    "Offensive Content",
+    "Harrassment and bullying",
+    "Harrassment and unwanted sexual content",
+    "Harrassment and leaking private Information",
+    "Harrassment and hate speech on certain groups",
+    "Danger",
+    "Illegally published content",
+    "Misinformation",
+]
+NUM_CATEGORIES = len(CATEGORIES)
+
+# How OpenAI is asked to reply:
+#   "text"     - one `Category: SCORE` line per category, parsed leniently by convert_string_to_dict
+#   "digits"   - a single string of 9 digits like 131111111
+#   "json"     - a JSON array of 9 integers
+#   "function" - a call to the report_scores function with the 9 scores as its argument
+# The compact formats need far fewer output tokens and are parsed strictly, a reply that doesn't fit raises ValueError.
+RESPONSE_FORMATS = ["text", "digits", "json", "function"]
+RESPONSE_FORMAT = "text"
+
+_executor = None
+_semaphore = None
+# CircuitBreaker told about every request the async path makes, see set_circuit_breaker.
+_breaker = None
 
 # There should be a file called 'tokens.json' inside the same folder as this file
 token_path = 'tokens.json'
@@ -13,6 +53,9 @@ with open(token_path) as f:
     tokens = json.load(f)
     openai.api_key = tokens['openai-key']
     openai.organization = tokens['openai-org']
+    # Optional, e.g. to point the bot at tools/mock_openai.py for benchmarks.
+    if 'openai-api-base' in tokens:
+        openai.api_base = tokens['openai-api-base']
 
 def convert_string_to_dict(message):
     result = OrderedDict()
@@ -25,17 +68,128 @@ def convert_string_to_dict(message):
                 result[item_type] = int(item_score)
     except (ValueError, IndexError):
         # Handle any exceptions that may occur during conversion
-        print(f"Error converting message: {message}. Skipping")
+        logger.warning("Error converting message: %s. Skipping", message)
     return result
 
-def get_openai_dict_scores(text):
-    start = time.time()
-    response = openai.ChatCompletion.create(
-    model="gpt-3.5-turbo",
-    # model="gpt-4",
-    messages=[
-    {"role": "system", "content": ""},
-    {"role": "user", "content": '''You are a content moderation system. 
+def convert_batch_string_to_dicts(message, count):
+    '''
+    Parses a reply to build_batch_prompt. Every item starts with an `Input N:` line followed by its category
+    lines. Returns a list with `count` entries in input order. An entry is None if its item is missing or
+    does not contain all the categories, so one malformed item doesn't fail the whole batch.
+    '''
+    results = [None] * count
+    blocks = re.split(r'^\s*Input\s+(\d+)\s*:?\s*$', message, flags=re.MULTILINE | re.IGNORECASE)
+    # re.split with a capture group gives [preamble, number, block, number, block, ...]
+    for i in range(1, len(blocks) - 1, 2):
+        index = int(blocks[i]) - 1
+        if index < 0 or index >= count or results[index] is not None:
+            continue
+        item_scores = convert_string_to_dict(blocks[i + 1])
+        if len(item_scores) == NUM_CATEGORIES:
+            results[index] = item_scores
+        else:
+            logger.warning("Error converting item %d of batched message. Skipping", index + 1)
+    return results
+
+def validate_scores(scores):
+    '''
+    Turns a list of scores into the same OrderedDict convert_string_to_dict returns. Raises ValueError unless
+    there is exactly one integer from 1 to 5 per category.
+    '''
+    if not isinstance(scores, list) or len(scores) != NUM_CATEGORIES:
+        raise ValueError(f"Expected {NUM_CATEGORIES} scores, got {scores!r}")
+    for score in scores:
+        if isinstance(score, bool) or not isinstance(score, int) or not 1 <= score <= 5:
+            raise ValueError(f"Scores must be integers from 1 to 5, got {scores!r}")
+    return OrderedDict(zip(CATEGORIES, scores))
+
+def parse_compact_scores(reply, response_format=None):
+    '''
+    Strict parser for the replies to the compact prompts. Raises ValueError if the reply doesn't have
+    exactly the expected shape.
+    '''
+    response_format = response_format or RESPONSE_FORMAT
+    if response_format == "digits":
+        m = re.fullmatch(r'\s*([1-5]{%d})\s*' % NUM_CATEGORIES, reply or "")
+        if not m:
+            raise ValueError(f"Expected {NUM_CATEGORIES} digits from 1 to 5, got {reply!r}")
+        return validate_scores([int(digit) for digit in m.group(1)])
+    try:
+        parsed = json.loads(reply)
+    except (TypeError, json.JSONDecodeError):
+        raise ValueError(f"Expected JSON, got {reply!r}")
+    if response_format == "function":
+        parsed = parsed.get('scores') if isinstance(parsed, dict) else None
+    return validate_scores(parsed)
+
+def parse_compact_batch_scores(reply, count, response_format=None):
+    '''
+    Strict parser for the replies to the compact batch prompts. Like convert_batch_string_to_dicts, returns
+    `count` entries with None for every item that is missing or malformed.
+    '''
+    response_format = response_format or RESPONSE_FORMAT
+    results = [None] * count
+    if response_format == "digits":
+        for m in re.finditer(r'^\s*(\d+)\s*[:.)]\s*([1-5]{%d})\s*$' % NUM_CATEGORIES, reply or "", flags=re.MULTILINE):
+            index = int(m.group(1)) - 1
+            if 0 <= index < count and results[index] is None:
+                results[index] = validate_scores([int(digit) for digit in m.group(2)])
+        return results
+
+    try:
+        parsed = json.loads(reply)
+    except (TypeError, json.JSONDecodeError):
+        return results
+    if response_format == "function":
+        parsed = parsed.get('scores') if isinstance(parsed, dict) else None
+    if not isinstance(parsed, list):
+        return results
+    for index, scores in enumerate(parsed[:count]):
+        try:
+            results[index] = validate_scores(scores)
+        except ValueError:
+            logger.warning("Error converting item %d of batched message. Skipping", index + 1)
+    return results
+
+def parse_reply(reply):
+    if RESPONSE_FORMAT == "text":
+        return convert_string_to_dict(reply)
+    return parse_compact_scores(reply)
+
+def parse_batch_reply(reply, count):
+    if RESPONSE_FORMAT == "text":
+        return convert_batch_string_to_dicts(reply, count)
+    return parse_compact_batch_scores(reply, count)
+
+def configure(max_concurrent_requests=None, request_timeout=None, response_format=None):
+    '''
+    Changes the concurrency limit and the per-call timeout used by get_openai_dict_scores_async, and the
+    response format used by every request. Should be called before the first async request is made.
+    '''
+    global MAX_CONCURRENT_REQUESTS, REQUEST_TIMEOUT, RESPONSE_FORMAT, _executor, _semaphore
+    if response_format:
+        if response_format not in RESPONSE_FORMATS:
+            raise ValueError(f"Unknown response format {response_format!r}, use one of {RESPONSE_FORMATS}")
+        RESPONSE_FORMAT = response_format
+    if max_concurrent_requests:
+        MAX_CONCURRENT_REQUESTS = max_concurrent_requests
+    if request_timeout:
+        REQUEST_TIMEOUT = request_timeout
+    _executor = None
+    _semaphore = None
+
+def set_circuit_breaker(breaker):
+    '''
+    Reports how every async OpenAI request went to `breaker`. Only the request itself is timed, not the
+    wait for a free slot or for a batch to fill up, so a burst of messages isn't blamed on OpenAI.
+    '''
+    global _breaker
+    _breaker = breaker
+
+def build_prompt(text):
+    if RESPONSE_FORMAT != "text":
+        return build_compact_prompt(text)
+    return '''You are a content moderation system. 
 
     Please classify if the following text from a web user is abusive, harmful and belongs to any of the following categories. For each category, reply one of 1, 2, 3, 4, 5. 
     1 means negligible level (like "I love you", "it's a cloudy day", "I hate that"). 
@@ -55,13 +209,176 @@ def get_openai_dict_scores(text):
     Misinformation: {SCORE}
 
     User input: 
-    ''' + text},
-    ]
+    ''' + text
+
+def build_batch_prompt(texts):
+    # Each text is a JSON string on one line, so a message can't start a line of its own like "Input 2:".
+    inputs = ""
+    for i, text in enumerate(texts):
+        inputs += f'''
+    Input {i + 1}: {json.dumps(text)}'''
+    if RESPONSE_FORMAT != "text":
+        return build_compact_prompt(inputs, len(texts))
+    return '''You are a content moderation system. 
+
+    Please classify if each of the following numbered texts from web users (each one written as a JSON string) is abusive, harmful and belongs to any of the following categories. For each text and each category, reply one of 1, 2, 3, 4, 5. 
+    1 means negligible level (like "I love you", "it's a cloudy day", "I hate that"). 
+    3 means moderately harmful (like "I hate you").
+    5 means very severe level (like "fuck your family", "vegans should die", "I'll kill you"). 
+    
+    Your reply should contain one block for every numbered text, in the same order. Each block starts with its number 
+    like "Input 1:" on its own line, uses the following format and contains all the following categories:
+
+    Scam: {SCORE}
+    Offensive Content: {SCORE}
+    Harrassment and bullying: {SCORE}
+    Harrassment and unwanted sexual content: {SCORE}
+    Harrassment and leaking private Information: {SCORE}
+    Harrassment and hate speech on certain groups: {SCORE}
+    Danger: {SCORE}
+    Illegally published content: {SCORE}
+    Misinformation: {SCORE}
+
+    User inputs: 
+    ''' + inputs
+
+def build_compact_prompt(text, count=None):
+    '''
+    Prompt for the compact response formats. `count` is the number of numbered inputs in `text` for a batch,
+    None for a single message.
+    '''
+    categories = "".join(f"    {i + 1}. {category}\n" for i, category in enumerate(CATEGORIES))
+    if count is None:
+        reply_format = {
+            "digits": f"Reply with exactly {NUM_CATEGORIES} digits and nothing else, one per category in the order above, like 131111111.",
+            "json": f"Reply with only a JSON array of {NUM_CATEGORIES} integers, one per category in the order above, like [1, 3, 1, 1, 1, 1, 1, 1, 1].",
+            "function": f"Call the report_scores function with {NUM_CATEGORIES} scores, one per category in the order above.",
+        }[RESPONSE_FORMAT]
+        input_header = "User input:"
+    else:
+        reply_format = {
+            "digits": f"Reply with one line per numbered text and nothing else. Each line is the number, a colon and {NUM_CATEGORIES} digits, one per category in the order above, like 1: 131111111.",
+            "json": f"Reply with only a JSON array that has one array of {NUM_CATEGORIES} integers per numbered text, in order, like [[1, 3, 1, 1, 1, 1, 1, 1, 1], [1, 1, 1, 1, 1, 1, 1, 1, 1]].",
+            "function": f"Call the report_scores function with one list of {NUM_CATEGORIES} scores per numbered text, in order.",
+        }[RESPONSE_FORMAT]
+        input_header = "User inputs:"
+
+    return f'''You are a content moderation system. 
+
+    Please classify if the following text from a web user is abusive, harmful and belongs to any of the following categories. For each category, give one of 1, 2, 3, 4, 5. 
+    1 means negligible level (like "I love you", "it's a cloudy day", "I hate that"). 
+    3 means moderately harmful (like "I hate you").
+    5 means very severe level (like "fuck your family", "vegans should die", "I'll kill you"). 
+
+    Categories:
+{categories}
+    {reply_format}
+
+    {input_header} 
+    ''' + text
+
+def completion_options(count=None):
+    '''
+    Extra ChatCompletion arguments for the current response format. The compact formats get a small
+    max_tokens so a rambling reply is cut off instead of slowing everything down.
+    '''
+    if RESPONSE_FORMAT == "text":
+        return {}
+    items = count or 1
+    options = {'temperature': 0, 'max_tokens': 20 + items * (12 if RESPONSE_FORMAT == "digits" else 30)}
+    if RESPONSE_FORMAT == "function":
+        score_list = {"type": "array", "items": {"type": "integer", "minimum": 1, "maximum": 5},
+                      "minItems": NUM_CATEGORIES, "maxItems": NUM_CATEGORIES}
+        options['functions'] = [{
+            "name": "report_scores",
+            "description": "Report the harm score of every category, in order.",
+            "parameters": {
+                "type": "object",
+                "properties": {"scores": score_list if count is None else {"type": "array", "items": score_list}},
+                "required": ["scores"],
+            },
+        }]
+        options['function_call'] = {"name": "report_scores"}
+    return options
+
+def request_completion(prompt, options=None, timeout=None):
+    # asyncio.wait_for in run_in_executor can't stop the thread, so the HTTP request itself has to give up
+    # too, or timed out calls keep holding one of the MAX_CONCURRENT_REQUESTS threads.
+    start = time.time()
+    response = openai.ChatCompletion.create(
+    model="gpt-3.5-turbo",
+    # model="gpt-4",
+    messages=[
+    {"role": "system", "content": ""},
+    {"role": "user", "content": prompt},
+    ],
+    request_timeout=timeout or REQUEST_TIMEOUT,
+    **(options or {})
     )
     end = time.time()
-    execution_time = end - start
-    print("Execution time:", execution_time, "seconds")
-    message = response['choices'][0]['message']['content']
+    metrics.observe("openai_request", end - start)
+    metrics.increment("openai_completion_tokens", response.get('usage', {}).get('completion_tokens', 0))
+    reply = response['choices'][0]['message']
+    # With function calling the scores are in the function arguments instead of the content.
+    if reply.get('function_call'):
+        return reply['function_call']['arguments']
+    message = reply['content']
     # print("OpenAI response message debug info: ")
     # print(message)
-    return convert_string_to_dict(message)
+    return message
+
+def get_openai_dict_scores(text):
+    return parse_reply(request_completion(build_prompt(text), completion_options()))
+
+async def get_openai_dict_scores_async(text, timeout=None):
+    '''
+    Same as get_openai_dict_scores, but does not block the event loop. The blocking OpenAI client runs
+    in a thread pool, at most MAX_CONCURRENT_REQUESTS calls are in flight at once and each call is
+    cancelled after `timeout` (or REQUEST_TIMEOUT) seconds with asyncio.TimeoutError.
+    '''
+    message = await run_in_executor(request_completion, build_prompt(text), completion_options(), timeout, timeout=timeout)
+    return parse_reply(message)
+
+async def get_openai_batch_scores_async(texts, timeout=None):
+    '''
+    Scores several texts with a single OpenAI request. Returns a list in input order; items OpenAI didn't
+    answer properly are ValueError instances instead of dicts, so callers can fail just those items.
+    '''
+    if len(texts) == 1:
+        return [await get_openai_dict_scores_async(texts[0], timeout=timeout)]
+    message = await run_in_executor(request_completion, build_batch_prompt(texts), completion_options(len(texts)), timeout, timeout=timeout)
+    results = []
+    for item_scores in parse_batch_reply(message, len(texts)):
+        results.append(item_scores if item_scores is not None else ValueError("OpenAI reply for this item was malformed"))
+    return results
+
+async def run_in_executor(func, *args, timeout=None):
+    global _executor, _semaphore
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS, thread_name_prefix="openai")
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    loop = asyncio.get_running_loop()
+    async with _semaphore:
+        start = time.perf_counter()
+        future = _executor.submit(func, *args)
+        if _breaker is not None:
+            # The request keeps running in its thread if we stop waiting for it, so the breaker hears how it
+            # actually went once it's done, not when the caller gave up.
+            breaker = _breaker
+            def done(f):
+                try:
+                    loop.call_soon_threadsafe(record_request, breaker, f, time.perf_counter() - start)
+                except RuntimeError:
+                    pass # The loop is already closed, we're shutting down
+            future.add_done_callback(done)
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout or REQUEST_TIMEOUT)
+
+def record_request(breaker, future, seconds):
+    if future.cancelled():
+        breaker.release_trial()
+    elif future.exception() is not None:
+        breaker.record_failure()
+    else:
+        breaker.record_success(seconds)
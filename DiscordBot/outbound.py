@@ -0,0 +1,157 @@
+# Sends the bot's moderation actions (deletions, notices and mod reports) to Discord in as few API calls as
+# possible, so a burst of flagged messages doesn't run into Discord's rate limits.
+
+import asyncio
+import logging
+from collections import Counter
+
+import discord
+
+from batcher import MicroBatcher
+from rate_limit import TokenBucket
+
+logger = logging.getLogger('modbot.outbound')
+
+# Discord messages are limited to 2000 characters.
+MAX_MESSAGE_LENGTH = 2000
+# Put between the reports of a digest message.
+DIGEST_SEPARATOR = "\n----------\n"
+# Bulk delete takes at most 100 messages.
+MAX_BULK_DELETE = 100
+
+# Our own limits per channel and route, a little under Discord's (about 5 requests per 5 seconds), so we
+# wait here instead of getting 429s.
+ROUTE_RATE = 1.0
+ROUTE_BURST = 5
+
+
+def chunk_lines(lines, separator="\n"):
+    '''
+    Joins lines into as few texts as possible that each fit in a Discord message. Returns a list of
+    (text, indexes of the lines in that text).
+    '''
+    chunks = []
+    text, indexes = "", []
+    for i, line in enumerate(lines):
+        line = line[:MAX_MESSAGE_LENGTH]
+        if text and len(text) + len(separator) + len(line) > MAX_MESSAGE_LENGTH:
+            chunks.append((text, indexes))
+            text, indexes = "", []
+        text = text + separator + line if text else line
+        indexes.append(i)
+    if text:
+        chunks.append((text, indexes))
+    return chunks
+
+
+class OutboundActions:
+    '''
+    Per channel, deletions that come in within `flush_ms` of each other are done with one bulk
+    `delete_messages` call, and notices are merged into one message (repeated notices are sent once with a
+    count). With `digest_reports`, mod reports are merged into digest messages too. Every call first takes a
+    token from the channel's bucket for that route, so deletions don't queue up behind notices at Discord.
+    '''
+
+    def __init__(self, metrics, flush_ms=100, digest_reports=False):
+        self.metrics = metrics
+        self.flush_ms = flush_ms
+        self.digest_reports = digest_reports
+        self.batchers = {} # Map from (route, channel ID) to MicroBatcher
+        self.buckets = {} # Map from (route, channel ID) to TokenBucket
+        self.tasks = set() # Notices being sent in the background
+
+    def batcher(self, route, channel, handler, max_items):
+        key = (route, channel.id)
+        batcher = self.batchers.get(key)
+        if batcher is None:
+            batcher = self.batchers[key] = MicroBatcher(lambda items: handler(channel, items), max_items, self.flush_ms)
+        return batcher
+
+    async def wait_for_bucket(self, route, channel):
+        key = (route, channel.id)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(ROUTE_RATE, ROUTE_BURST)
+        with self.metrics.timer("discord_rate_limit_wait"):
+            await bucket.acquire()
+
+    async def delete(self, message):
+        '''
+        Deletes a message. Returns once it's gone, which may be in a bulk delete with other messages.
+        '''
+        await self.batcher("delete", message.channel, self.delete_batch, MAX_BULK_DELETE).submit(message)
+
+    async def delete_batch(self, channel, messages):
+        await self.wait_for_bucket("delete", channel)
+        with self.metrics.timer("discord_delete"):
+            if len(messages) == 1:
+                await self.delete_one(messages[0])
+            else:
+                self.metrics.increment("discord_bulk_deletes")
+                try:
+                    await channel.delete_messages(messages)
+                except discord.HTTPException:
+                    # Bulk delete refuses messages older than two weeks, fall back to deleting one by one.
+                    logger.warning("Bulk delete of %d messages failed, deleting them one by one.", len(messages), exc_info=True)
+                    for message in messages:
+                        await self.delete_one(message)
+        return [None] * len(messages)
+
+    async def delete_one(self, message):
+        try:
+            await message.delete()
+        except discord.NotFound:
+            pass
+
+    def notify(self, channel, text):
+        '''
+        Posts a notice in `channel` in the background, merged with other notices for that channel.
+        '''
+        task = asyncio.get_running_loop().create_task(self.send_notice(channel, text))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send_notice(self, channel, text):
+        try:
+            await self.batcher("notice", channel, self.notice_batch, 100).submit(text)
+        except Exception:
+            logger.warning("Failed to send a notice to %s.", channel.name, exc_info=True)
+
+    async def notice_batch(self, channel, texts):
+        counts = Counter(texts)
+        lines = [text if count == 1 else f"{text} (x{count})" for text, count in counts.items()]
+        self.metrics.increment("notices_merged", len(texts) - len(lines))
+        for text, _ in chunk_lines(lines):
+            await self.wait_for_bucket("send", channel)
+            with self.metrics.timer("discord_send"):
+                await channel.send(text)
+        return [None] * len(texts)
+
+    async def send_report(self, channel, text):
+        '''
+        Posts a report in the mod channel. Returns (message it was posted in, position of the report in
+        that message), where the position is None unless reports are sent as digests.
+        '''
+        if self.digest_reports:
+            return await self.batcher("report", channel, self.report_batch, 50).submit(text)
+        await self.wait_for_bucket("send", channel)
+        with self.metrics.timer("discord_send"):
+            return await channel.send(text), None
+
+    async def report_batch(self, channel, texts):
+        results = [None] * len(texts)
+        for text, indexes in chunk_lines(texts, separator=DIGEST_SEPARATOR):
+            await self.wait_for_bucket("send", channel)
+            with self.metrics.timer("discord_send"):
+                sent = await channel.send(text)
+            for position, i in enumerate(indexes):
+                # A digest that ended up with one report is just a normal report message.
+                results[i] = (sent, position if len(indexes) > 1 else None)
+        self.metrics.increment("report_digests")
+        return results
+
+    async def close(self):
+        for batcher in self.batchers.values():
+            batcher.flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
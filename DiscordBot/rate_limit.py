@@ -0,0 +1,44 @@
+# Helpers for staying under API rate limits.
+
+import asyncio
+import random
+import time
+
+
+class TokenBucket:
+    '''
+    Allows `rate` operations per second on average, with bursts of up to `capacity` operations.
+    `acquire` waits until a token is available.
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        self.refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens=1):
+        async with self.lock:
+            while not self.try_acquire(tokens):
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+def backoff_delay(attempt, base=1.0, maximum=32.0):
+    '''
+    Seconds to wait before retry number `attempt` (starting at 0): exponential with full jitter,
+    so clients that failed together don't all retry at the same moment.
+    '''
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
@@ -79,7 +79,7 @@ class Report:
                 return ["It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."]
             try:
                 self.report_message_link = message.content
-                message = await channel.fetch_message(int(m.group(3)))
+                message = await self.client.resolve_message(channel, int(m.group(3)))
                 self.report_message = message
             except discord.errors.NotFound:
                 return ["It seems this message was deleted or never existed. Please try again or say `cancel` to cancel."]
@@ -174,7 +174,8 @@ class Report:
 
     async def send_mod_message(self):
         mod_message = self.get_report_information()
-        await self.mod_channel.send(formatter.format_dict_to_str(mod_message))
+        sent = await self.client.timed_send(self.mod_channel, formatter.format_dict_to_str(mod_message))
+        self.client.queue_for_review(sent, mod_message)
 
     def get_report_information(self):
         mod_message = OrderedDict()
@@ -0,0 +1,75 @@
+# Circuit breaker for calls to external services (OpenAI), so the bot stops waiting on a service that is down.
+
+import logging
+import time
+
+logger = logging.getLogger('modbot.resilience')
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    '''
+    Counts consecutive failures and slow calls. After `failure_threshold` of them in a row the circuit opens
+    and `allow` returns False for `reset_timeout` seconds, so callers go straight to their fallback. After
+    that one trial call is let through (half-open): if it succeeds the circuit closes again, otherwise it
+    stays open for another `reset_timeout`. A trial nobody hears back from within `reset_timeout` (e.g. it
+    was cancelled) is given up on, and the next call becomes the trial.
+    '''
+
+    def __init__(self, name, failure_threshold=5, slow_call_seconds=5.0, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.trial_started = 0.0
+
+    def allow(self):
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN and now - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self.trial_in_flight = False
+        if self.state == HALF_OPEN and (not self.trial_in_flight or now - self.trial_started >= self.reset_timeout):
+            self.trial_in_flight = True
+            self.trial_started = now
+            return True
+        return False
+
+    def record_success(self, seconds):
+        # A call that worked but took too long still counts against the service.
+        if self.slow_call_seconds is not None and seconds > self.slow_call_seconds:
+            self.record_failure()
+            return
+        if self.state != CLOSED:
+            logger.info("%s circuit closed again.", self.name)
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                logger.warning("%s circuit opened after %d failed or slow calls.", self.name, self.consecutive_failures)
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+    def release_trial(self):
+        '''
+        For a half-open trial call that never reached the service: lets the next call be the trial instead.
+        '''
+        if self.state == HALF_OPEN:
+            self.trial_in_flight = False
+
+    def is_open(self):
+        return self.state == OPEN
@@ -3,6 +3,7 @@
 from enum import Enum, auto
 import discord
 import formatter
+from outbound import DIGEST_SEPARATOR
 from collections import OrderedDict
 import re
 
@@ -18,12 +19,15 @@ class State(Enum):
 
 class Review:
     START_KEYWORD = "review"
+    NEXT_KEYWORD = "next"
     CANCEL_KEYWORD = "cancel"
     HELP_KEYWORD = "help"
 
-    def __init__(self, client):
+    def __init__(self, client, reviewer_id):
         self.state = State.REVIEW_START
         self.client = client
+        self.reviewer_id = reviewer_id
+        self.queue_id = None # ID of the mod message we hold in the review queue, if any
         self.auto_reported = None
         self.reported_message = None
         self.review_flow = ""
@@ -36,6 +40,14 @@ class Review:
             return ["Review cancelled."]
         
         if self.state == State.REVIEW_START:
+            if message.content == self.NEXT_KEYWORD:
+                item = self.client.review_queue.claim_next(self.reviewer_id)
+                if item is None:
+                    self.state = State.REVIEW_COMPLETED
+                    return ["There are no reports waiting for review."]
+                self.queue_id = item.mod_message_id
+                return self.identify_report(item.info)
+
             reply =  "Thank you for starting the review process. "
             reply += "Say `help` at any time for more information.\n\n"
             reply += "Please copy paste the link to the message you want to review.\n"
@@ -55,21 +67,22 @@ class Review:
             if not channel:
                 return ["It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."]
             try:
-                message = await channel.fetch_message(int(m.group(3)))
+                message = await self.client.resolve_message(channel, int(m.group(3)))
                 self.reported_message = message
             except discord.errors.NotFound:
                 return ["It seems this message was deleted or never existed. Please try again or say `cancel` to cancel."]
-            
-            self.state = State.MESSAGE_IDENTIFIED
-            self.review_flow += "review has been started ->"
-            self.message_info = formatter.unformat_str_to_dict(message.content)
 
-            reply = "I found this message: ```" + self.message_info['author'] + ": " + self.message_info['message'] + "```\n"
-            reply += "Please make a determination below:\n"
-            reply += f"  `1: Content does not violate policies.`\n"
-            reply += f"  `2: Content might violate policies.`\n"
-            reply += f"  `3: Content does violate policies.`\n"
-            return [reply]
+            queue = self.client.review_queue
+            if queue.owner(message.id) not in (None, self.reviewer_id):
+                return ["Another moderator is already reviewing this report. Please paste another link or say `cancel` to cancel."]
+            item = queue.claim(message.id, self.reviewer_id)
+            if item is None:
+                if DIGEST_SEPARATOR in message.content:
+                    return ["That message is a digest of several reports. Please say `cancel` and use `next` to review them one at a time."]
+                # Reports posted before the bot restarted aren't queued, so read them back from the mod message.
+                return self.identify_report(formatter.unformat_str_to_dict(message.content))
+            self.queue_id = item.mod_message_id
+            return self.identify_report(item.info)
         
         if self.state == State.MESSAGE_IDENTIFIED:
             if '1' in message.content:
@@ -128,6 +141,18 @@ class Review:
         
         return ["Wrong input. Please select the reason again."]
     
+    def identify_report(self, message_info):
+        self.state = State.MESSAGE_IDENTIFIED
+        self.review_flow += "review has been started ->"
+        self.message_info = message_info
+
+        reply = "I found this message: ```" + self.message_info['author'] + ": " + self.message_info['message'] + "```\n"
+        reply += "Please make a determination below:\n"
+        reply += f"  `1: Content does not violate policies.`\n"
+        reply += f"  `2: Content might violate policies.`\n"
+        reply += f"  `3: Content does violate policies.`\n"
+        return [reply]
+
     def review_complete(self):
         return self.state == State.REVIEW_COMPLETED
     
@@ -0,0 +1,115 @@
+# Append-only log of completed reviews, used by tools/analyze_log.py.
+
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('modbot.review_log')
+
+# Bump this when the fields of a log record change, so analysis tools can tell old rows apart.
+SCHEMA_VERSION = 1
+
+
+class ReviewLogWriter:
+    '''
+    Writes one JSON object per line. Records are buffered in memory and written by a background task
+    every `flush_interval` seconds (or sooner once `max_buffered` records are waiting) on a worker thread,
+    so the event loop never does file I/O. `fsync_interval` is how often (in seconds) written data is also
+    forced to disk: 0 fsyncs after every flush and None leaves it to the OS. Once the file grows past
+    `max_bytes` it is rotated to `<path>.1`, `<path>.2`, ... keeping `backup_count` old files.
+    '''
+
+    def __init__(self, path, flush_interval=1.0, max_buffered=1000, fsync_interval=5.0, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        self.buffer = []
+        self.flush_task = None
+        self.wakeup = None
+        self.last_fsync = time.time()
+        self.file = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="review-log")
+
+    def start(self):
+        if self.flush_task is None:
+            self.wakeup = asyncio.Event()
+            self.flush_task = asyncio.get_running_loop().create_task(self.flush_periodically())
+
+    def write(self, review):
+        record = {
+            'v': SCHEMA_VERSION,
+            'ts': time.time(),
+            'reporter': str(review['reporter']),
+            'author': str(review['author']),
+            'message': review['message'],
+            'link': review.get('link'),
+            'violated': bool(review['violated']),
+        }
+        self.buffer.append(json.dumps(record, ensure_ascii=False) + "\n")
+        if len(self.buffer) >= self.max_buffered and self.wakeup is not None:
+            self.wakeup.set()
+
+    async def flush_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except OSError as e:
+                logger.warning("Failed to write review log: %s", e)
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        lines = self.buffer
+        self.buffer = []
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.write_lines, lines)
+
+    def write_lines(self, lines):
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.file.writelines(lines)
+        self.file.flush()
+
+        now = time.time()
+        if self.fsync_interval is not None and now - self.last_fsync >= self.fsync_interval:
+            os.fsync(self.file.fileno())
+            self.last_fsync = now
+
+        if self.max_bytes and self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.close_file)
+        self.executor.shutdown()
+
+    def close_file(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
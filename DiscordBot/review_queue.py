@@ -0,0 +1,130 @@
+# Queue of reports waiting in the mod channel, so moderators can ask for the next one instead of copying links.
+
+import heapq
+import itertools
+import time
+
+# Reports without a priority are queued behind the ones that have one. Lower numbers are more urgent.
+DEFAULT_PRIORITY = 3
+
+
+class QueueItem:
+    def __init__(self, mod_message_id, info, priority, created):
+        self.mod_message_id = mod_message_id
+        self.info = info # The report as it was posted in the mod channel
+        self.priority = priority
+        self.created = created
+        self.reviewer = None
+        self.lease_expires = 0.0
+
+
+class ReviewQueue:
+    '''
+    Pending reports indexed by the ID of their message in the mod channel. `claim_next` hands out the most
+    urgent report (oldest first within a priority) and leases it to that moderator for `lease_seconds`, so
+    no one else gets it. The lease is renewed while the moderator is working on it, and if they go quiet
+    the report goes back into the queue once the lease runs out.
+    '''
+
+    def __init__(self, lease_seconds=600):
+        self.lease_seconds = lease_seconds
+        self.items = {} # Map from mod message ID to QueueItem, pending or claimed
+        self.heap = [] # (priority, created, seq, mod message ID) of unclaimed items, may hold stale entries
+        self.leases = [] # (lease expiry, seq, mod message ID) of claimed items, may hold stale entries
+        self.counter = itertools.count()
+
+    def add(self, mod_message_id, info, priority=None, created=None):
+        if priority is None:
+            priority = DEFAULT_PRIORITY
+        item = QueueItem(mod_message_id, info, priority, time.monotonic() if created is None else created)
+        self.items[mod_message_id] = item
+        self.push(item)
+        return item
+
+    def push(self, item):
+        heapq.heappush(self.heap, (item.priority, item.created, next(self.counter), item.mod_message_id))
+
+    def claim_next(self, reviewer):
+        '''
+        Leases the most urgent unclaimed report to `reviewer`. Returns its QueueItem, or None if the queue is empty.
+        '''
+        now = time.monotonic()
+        self.expire_leases(now)
+        while self.heap:
+            _, _, _, mod_message_id = heapq.heappop(self.heap)
+            item = self.items.get(mod_message_id)
+            # Entries for completed or already claimed reports are skipped here instead of being removed from the heap.
+            if item is None or item.reviewer is not None:
+                continue
+            self.lease(item, reviewer, now)
+            return item
+        return None
+
+    def claim(self, mod_message_id, reviewer):
+        '''
+        Leases a specific report to `reviewer`, for moderators who paste a link. Returns the QueueItem, or None
+        if the report isn't queued (it was posted before a restart, or is already done) or someone else holds it.
+        '''
+        now = time.monotonic()
+        self.expire_leases(now)
+        item = self.items.get(mod_message_id)
+        if item is None or item.reviewer not in (None, reviewer):
+            return None
+        self.lease(item, reviewer, now)
+        return item
+
+    def owner(self, mod_message_id):
+        '''
+        The moderator currently holding the report, or None.
+        '''
+        self.expire_leases(time.monotonic())
+        item = self.items.get(mod_message_id)
+        return item.reviewer if item else None
+
+    def renew(self, mod_message_id, reviewer):
+        item = self.items.get(mod_message_id)
+        if item is not None and item.reviewer == reviewer:
+            self.lease(item, reviewer, time.monotonic())
+
+    def release(self, mod_message_id, reviewer):
+        '''
+        Puts a claimed report back in the queue, e.g. when the review is cancelled.
+        '''
+        item = self.items.get(mod_message_id)
+        if item is not None and item.reviewer == reviewer:
+            item.reviewer = None
+            self.push(item)
+
+    def complete(self, mod_message_id, reviewer):
+        '''
+        Removes a report `reviewer` has finished reviewing. Returns its QueueItem, or None if the reviewer
+        doesn't hold it (any more), e.g. their lease ran out and someone else claimed it.
+        '''
+        self.expire_leases(time.monotonic())
+        item = self.items.get(mod_message_id)
+        if item is None or item.reviewer != reviewer:
+            return None
+        return self.items.pop(mod_message_id)
+
+    def lease(self, item, reviewer, now):
+        item.reviewer = reviewer
+        item.lease_expires = now + self.lease_seconds
+        heapq.heappush(self.leases, (item.lease_expires, next(self.counter), item.mod_message_id))
+
+    def expire_leases(self, now):
+        while self.leases and self.leases[0][0] <= now:
+            expires, _, mod_message_id = heapq.heappop(self.leases)
+            item = self.items.get(mod_message_id)
+            # Renewed leases leave their old expiry behind, only the latest one counts.
+            if item is None or item.reviewer is None or item.lease_expires != expires:
+                continue
+            item.reviewer = None
+            self.push(item)
+
+    def stats(self):
+        self.expire_leases(time.monotonic())
+        claimed = sum(1 for item in self.items.values() if item.reviewer is not None)
+        return {'pending': len(self.items) - claimed, 'claimed': claimed}
+
+    def __len__(self):
+        return len(self.items)
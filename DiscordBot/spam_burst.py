@@ -0,0 +1,177 @@
+# Spots raids that post the same (or nearly the same) text over and over, so a copy can reuse the verdict
+# of the first one instead of being scored again.
+
+import asyncio
+import itertools
+import re
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+SIGNATURE_BITS = 64
+# Signatures are split into this many bands for the LSH buckets. Two signatures that differ in fewer bits
+# than there are bands always share at least one band exactly, so MAX_DISTANCE < BANDS finds every match.
+BANDS = 4
+BAND_BITS = SIGNATURE_BITS // BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+HASH_MASK = (1 << SIGNATURE_BITS) - 1
+MAX_DISTANCE = 3
+
+# SimHash of short texts is too noisy to trust: "I love you" and "I kill you" can land close together.
+# Texts shorter than this (after normalizing) only match exact copies.
+MIN_FUZZY_LENGTH = 20
+SHINGLE_SIZE = 4
+
+
+def normalize(text):
+    # Raids often vary punctuation and spacing between copies, so only letters and digits count.
+    return re.sub(r'\s+', ' ', re.sub(r'[^\w\s]', '', text.lower())).strip()
+
+
+def simhash(text):
+    '''
+    64-bit SimHash over the character 4-grams of an already normalized text. Texts that share most of
+    their 4-grams get signatures that differ in only a few bits. Uses Python's string hash, so signatures
+    are only comparable within one process.
+    '''
+    shingles = {text[i:i + SHINGLE_SIZE] for i in range(max(1, len(text) - SHINGLE_SIZE + 1))}
+    hashes = np.fromiter((hash(shingle) & HASH_MASK for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    # ones[b] is how many shingle hashes have bit b set. A bit is set in the signature if most hashes have it.
+    ones = np.unpackbits(hashes.view(np.uint8), bitorder='little').reshape(-1, SIGNATURE_BITS).sum(0)
+    bits = np.packbits(ones * 2 > len(shingles), bitorder='little')
+    return int.from_bytes(bits.tobytes(), 'little')
+
+
+def bands(signature):
+    return [(i, signature >> (i * BAND_BITS) & BAND_MASK) for i in range(BANDS)]
+
+
+class SpamCluster:
+    '''
+    Messages that are near-duplicates of the first one. The first message (the leader) is scored as usual
+    and `decide` stores what was done with it. The other copies wait for that in `wait_for_verdict`.
+    '''
+
+    def __init__(self, id, text, signature, author_id, now):
+        self.id = id
+        self.text = text
+        self.signature = signature
+        self.created = now
+        self.last_seen = now
+        self.count = 1
+        self.authors = {author_id}
+        self.verdict = None
+        self.decided = asyncio.Event()
+        self.reported = False # Whether the mod channel has been told about the burst
+
+    def decide(self, verdict):
+        self.verdict = verdict
+        self.decided.set()
+
+    async def wait_for_verdict(self):
+        await self.decided.wait()
+        return self.verdict
+
+
+class GuildWindow:
+    '''
+    Clusters of one guild that had a message in the last `window_seconds`, with LSH buckets over the bands
+    of each cluster's signature.
+    '''
+
+    def __init__(self, window_seconds, max_clusters):
+        self.window_seconds = window_seconds
+        self.max_clusters = max_clusters
+        self.clusters = OrderedDict() # Map from cluster ID to SpamCluster, least recently seen first
+        self.buckets = {} # Map from (band index, band value) to set of cluster IDs
+        self.exact = {} # Map from text to cluster ID, for texts too short to have a signature
+
+    def find(self, text, signature):
+        if signature is None:
+            return self.clusters.get(self.exact.get(text))
+        best, best_distance = None, MAX_DISTANCE + 1
+        for band in bands(signature):
+            for cluster_id in self.buckets.get(band, ()):
+                cluster = self.clusters[cluster_id]
+                distance = (cluster.signature ^ signature).bit_count()
+                if distance < best_distance:
+                    best, best_distance = cluster, distance
+        return best
+
+    def add(self, cluster):
+        self.clusters[cluster.id] = cluster
+        if cluster.signature is None:
+            self.exact[cluster.text] = cluster.id
+        else:
+            for band in bands(cluster.signature):
+                self.buckets.setdefault(band, set()).add(cluster.id)
+
+    def touch(self, cluster, now):
+        cluster.last_seen = now
+        self.clusters.move_to_end(cluster.id)
+
+    def expire(self, now):
+        cutoff = now - self.window_seconds
+        while self.clusters:
+            cluster = next(iter(self.clusters.values()))
+            if cluster.last_seen >= cutoff and len(self.clusters) <= self.max_clusters:
+                break
+            self.remove(cluster)
+
+    def remove(self, cluster):
+        del self.clusters[cluster.id]
+        if cluster.signature is None:
+            self.exact.pop(cluster.text, None)
+            return
+        for band in bands(cluster.signature):
+            bucket = self.buckets.get(band)
+            if bucket is not None:
+                bucket.discard(cluster.id)
+                if not bucket:
+                    del self.buckets[band]
+
+
+class SpamBurstDetector:
+    '''
+    Groups each guild's recent messages into clusters of near-duplicates. A cluster lives until nothing
+    has been added to it for `window_seconds`, and each guild keeps at most `max_clusters` clusters.
+    '''
+
+    def __init__(self, window_seconds=120, max_clusters=5000):
+        self.window_seconds = window_seconds
+        self.max_clusters = max_clusters
+        self.windows = {} # Map from guild ID to GuildWindow
+        self.ids = itertools.count()
+
+    def observe(self, guild_id, text, author_id):
+        '''
+        Adds a message to its cluster. Returns (cluster, is_leader, exact): is_leader is True if the message
+        started a new cluster and has to be scored, exact is True if its text is the same as the first
+        message's after normalizing.
+        '''
+        now = time.monotonic()
+        window = self.windows.get(guild_id)
+        if window is None:
+            window = self.windows[guild_id] = GuildWindow(self.window_seconds, self.max_clusters)
+        window.expire(now)
+
+        normalized = normalize(text)
+        if len(normalized) < MIN_FUZZY_LENGTH:
+            # Punctuation is kept here, or every emoji-only message would land in the same cluster.
+            text, signature = re.sub(r'\s+', ' ', text.lower()).strip(), None
+        else:
+            text, signature = normalized, simhash(normalized)
+        cluster = window.find(text, signature)
+        if cluster is None:
+            cluster = SpamCluster(next(self.ids), text, signature, author_id, now)
+            window.add(cluster)
+            return cluster, True, True
+
+        cluster.count += 1
+        cluster.authors.add(author_id)
+        window.touch(cluster, now)
+        return cluster, False, text == cluster.text
+
+    def stats(self):
+        return {'clusters': sum(len(window.clusters) for window in self.windows.values())}
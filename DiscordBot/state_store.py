@@ -0,0 +1,154 @@
+# Durable storage for moderation state (reports, reviews, bans and banned regexes).
+
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('modbot.state')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY,
+    reporter TEXT,
+    author TEXT,
+    message TEXT,
+    link TEXT,
+    priority INTEGER,
+    metadata TEXT,
+    created REAL
+);
+CREATE INDEX IF NOT EXISTS reports_reporter ON reports (reporter);
+CREATE INDEX IF NOT EXISTS reports_author ON reports (author);
+
+CREATE TABLE IF NOT EXISTS reviews (
+    id INTEGER PRIMARY KEY,
+    reporter TEXT,
+    author TEXT,
+    message TEXT,
+    link TEXT,
+    metadata TEXT,
+    violated INTEGER,
+    created REAL
+);
+CREATE INDEX IF NOT EXISTS reviews_reporter ON reviews (reporter, violated);
+CREATE INDEX IF NOT EXISTS reviews_author ON reviews (author, violated);
+
+CREATE TABLE IF NOT EXISTS bans (
+    user_id INTEGER,
+    reason TEXT,
+    created REAL,
+    PRIMARY KEY (user_id, reason)
+);
+
+CREATE TABLE IF NOT EXISTS ban_rules (
+    rule TEXT PRIMARY KEY,
+    created REAL
+);
+'''
+
+INSERT_STATEMENTS = {
+    'reports': "INSERT INTO reports (reporter, author, message, link, priority, metadata, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+    'reviews': "INSERT INTO reviews (reporter, author, message, link, metadata, violated, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+    'bans': "INSERT OR IGNORE INTO bans (user_id, reason, created) VALUES (?, ?, ?)",
+    'ban_rules': "INSERT OR IGNORE INTO ban_rules (rule, created) VALUES (?, ?)",
+}
+
+
+class StateStore:
+    '''
+    SQLite (WAL mode) store for the moderation state that has to survive restarts. Writes are queued
+    in memory and written in one transaction every `flush_interval` seconds by a background task, so
+    the event loop never waits on disk. All database work happens on a single worker thread.
+    '''
+
+    def __init__(self, db_path, flush_interval=1.0):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.pending = [] # List of (table, row) waiting to be written
+        self.flush_task = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-store")
+
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def start(self):
+        if self.flush_task is None:
+            self.flush_task = asyncio.get_running_loop().create_task(self.flush_periodically())
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except sqlite3.Error as e:
+                logger.warning("Failed to write moderation state: %s", e)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch = self.pending
+        self.pending = []
+        await self.run(self.write_batch, batch)
+
+    def write_batch(self, batch):
+        rows_per_table = {}
+        for table, row in batch:
+            rows_per_table.setdefault(table, []).append(row)
+        with self.db:
+            for table, rows in rows_per_table.items():
+                self.db.executemany(INSERT_STATEMENTS[table], rows)
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        await self.run(self.db.close)
+        self.executor.shutdown()
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    # Writes. These only queue the row, it is written on the next flush.
+
+    def add_report(self, report):
+        self.pending.append(('reports', (str(report['reporter']), str(report['author']), report['message'], report['link'],
+                                         report.get('priority'), report['metadata'], time.time())))
+
+    def add_review(self, review):
+        self.pending.append(('reviews', (str(review['reporter']), str(review['author']), review['message'], review['link'],
+                                         review['metadata'], int(bool(review['violated'])), time.time())))
+
+    def add_ban(self, user_id, reason):
+        self.pending.append(('bans', (user_id, reason, time.time())))
+
+    def add_ban_rule(self, rule):
+        self.pending.append(('ban_rules', (rule, time.time())))
+
+    # Reads. These are meant to be called through `run` so they happen on the worker thread.
+
+    def load_ban_rules(self):
+        return [row[0] for row in self.db.execute("SELECT rule FROM ban_rules ORDER BY created")]
+
+    def load_bans(self, reason):
+        # reason is offenders.BANNED_POSTER or offenders.BANNED_REPORTER
+        return {row[0] for row in self.db.execute("SELECT user_id FROM bans WHERE reason = ?", (reason,))}
+
+    def load_false_report_counts(self):
+        rows = self.db.execute("SELECT reporter, COUNT(*) FROM reviews WHERE violated = 0 GROUP BY reporter")
+        return Counter(dict(rows.fetchall()))
+
+    def load_violation_counts(self):
+        rows = self.db.execute("SELECT author, COUNT(*) FROM reviews WHERE violated = 1 GROUP BY author")
+        return Counter(dict(rows.fetchall()))
+
+    def load_recent(self, table, limit):
+        cursor = self.db.execute(f"SELECT * FROM {table} ORDER BY id DESC LIMIT ?", (limit,))
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in reversed(cursor.fetchall())]
@@ -1,28 +1,210 @@
-# Example tool that shows how the logs can be analayzed to draw conclusions. 
-# In this example, the 
+# Example tool that shows how the logs can be analayzed to draw conclusions.
+# The review log is read once into NumPy columns that are saved next to it, so later runs only read the
+# lines that were added since. Run `python analyze_log.py --help` to see the available queries.
 
-with open("../logging/log.txt") as file:
-    # A report is valid if the reviewer agrees it violated content
-    num_valid_reports = 0
+import argparse
+import json
+import os
 
-    # A report is invalid if the reviewer disagrees it violated content
-    num_invalid_reports = 0
+import numpy as np
 
-    # Total number of reports that have been reviewed
-    report_count = 0
+# Reviews are logged as JSON lines by review_log.ReviewLogWriter. Older runs wrote pipe-delimited lines to log.txt.
+log_dir = "../logging"
+log_name = "reviews.jsonl"
+legacy_log_name = "log.txt"
+checkpoint_name = "reviews-columns.npz"
 
-    for line in file:
-        parts = line.strip().split("|")
-        report_valid = parts[3]
+BUCKET_SECONDS = {'minute': 60, 'hour': 3600, 'day': 86400}
 
-        if report_valid == "True":
-            num_valid_reports += 1
-        else:
-            num_invalid_reports += 1
 
-        report_count += 1
+class ReviewColumns:
+    '''
+    Completed reviews stored column by column. Reporter and author IDs are stored as indexes into
+    `reporters` and `authors`, so every column is a flat NumPy array. `offsets` remembers how far into
+    each log file we've read (and which file that was), so `update` only parses new lines.
+    '''
 
+    def __init__(self):
+        self.ts = np.zeros(0, dtype=np.float64)
+        self.reporter = np.zeros(0, dtype=np.int32)
+        self.author = np.zeros(0, dtype=np.int32)
+        self.violated = np.zeros(0, dtype=bool)
+        self.reporters = []
+        self.authors = []
+        self.offsets = {} # Map from log file name to {'inode': ..., 'offset': ...}
 
-    print(f"The total number of reports {report_count}")
+    @classmethod
+    def load(cls, path):
+        columns = cls()
+        if not os.path.exists(path):
+            return columns
+        data = np.load(path, allow_pickle=False)
+        columns.ts = data['ts']
+        columns.reporter = data['reporter']
+        columns.author = data['author']
+        columns.violated = data['violated']
+        columns.reporters = data['reporters'].tolist()
+        columns.authors = data['authors'].tolist()
+        columns.offsets = json.loads(str(data['offsets']))
+        return columns
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, ts=self.ts, reporter=self.reporter, author=self.author, violated=self.violated,
+                     reporters=np.array(self.reporters, dtype=str), authors=np.array(self.authors, dtype=str),
+                     offsets=np.array(json.dumps(self.offsets)))
+        os.replace(tmp_path, path)
+
+    def update(self, directory):
+        '''
+        Reads whatever was appended to the logs since the last update. Returns the number of new rows.
+        '''
+        reporter_codes = {name: i for i, name in enumerate(self.reporters)}
+        author_codes = {name: i for i, name in enumerate(self.authors)}
+        ts, reporter, author, violated = [], [], [], []
+
+        def add_row(row_ts, row_reporter, row_author, row_violated):
+            ts.append(row_ts)
+            reporter.append(code_for(reporter_codes, self.reporters, row_reporter))
+            author.append(code_for(author_codes, self.authors, row_author))
+            violated.append(row_violated)
+
+        self.read_new_lines(directory, legacy_log_name, lambda line: parse_legacy_line(line, add_row))
+        self.read_new_lines(directory, log_name, lambda line: parse_json_line(line, add_row))
+
+        if ts:
+            self.ts = np.concatenate([self.ts, np.array(ts, dtype=np.float64)])
+            self.reporter = np.concatenate([self.reporter, np.array(reporter, dtype=np.int32)])
+            self.author = np.concatenate([self.author, np.array(author, dtype=np.int32)])
+            self.violated = np.concatenate([self.violated, np.array(violated, dtype=bool)])
+        return len(ts)
+
+    def read_new_lines(self, directory, name, parse):
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            return
+        seen = self.offsets.get(name, {'inode': None, 'offset': 0})
+        inode = os.stat(path).st_ino
+
+        if seen['inode'] is not None and seen['inode'] != inode:
+            # The log was rotated since we last read it. Finish the part of the old file we haven't seen yet.
+            rotated_path = path + ".1"
+            if os.path.exists(rotated_path) and os.stat(rotated_path).st_ino == seen['inode']:
+                read_lines_from(rotated_path, seen['offset'], parse)
+            seen = {'inode': inode, 'offset': 0}
+
+        offset = read_lines_from(path, seen['offset'], parse)
+        self.offsets[name] = {'inode': inode, 'offset': offset}
+
+    def __len__(self):
+        return len(self.ts)
+
+
+def read_lines_from(path, offset, parse):
+    '''
+    Calls `parse` on every complete line after `offset` bytes. Returns the offset after the last complete
+    line, so a line that is still being written gets read next time.
+    '''
+    with open(path, "rb") as file:
+        file.seek(offset)
+        for line in file:
+            if not line.endswith(b"\n"):
+                break
+            parse(line.decode("utf-8", errors="replace"))
+            offset += len(line)
+    return offset
+
+
+def parse_legacy_line(line, add_row):
+    parts = line.strip().split("|")
+    # Old rows had no timestamp, and messages containing | split into too many parts.
+    add_row(np.nan, parts[0], parts[1], parts[-1] == "True")
+
+
+def parse_json_line(line, add_row):
+    try:
+        record = json.loads(line)
+    except json.JSONDecodeError:
+        return
+    add_row(record.get('ts', np.nan), record['reporter'], record['author'], bool(record['violated']))
+
+
+def code_for(codes, names, name):
+    code = codes.get(name)
+    if code is None:
+        code = len(names)
+        codes[name] = code
+        names.append(name)
+    return code
+
+
+def print_summary(columns):
+    num_valid_reports = int(columns.violated.sum())
+    print(f"The total number of reports {len(columns)}")
     print(f"The number of valid reports {num_valid_reports}")
-    print(f"The number of invalid reports {num_invalid_reports}")
\ No newline at end of file
+    print(f"The number of invalid reports {len(columns) - num_valid_reports}")
+
+
+def print_false_report_rates(columns, top, min_reports):
+    total = np.bincount(columns.reporter, minlength=len(columns.reporters))
+    false = np.bincount(columns.reporter, weights=~columns.violated, minlength=len(columns.reporters))
+    rate = np.divide(false, total, out=np.zeros(len(total)), where=total > 0)
+
+    candidates = np.flatnonzero(total >= min_reports)
+    # Highest false report rate first, more reports first when rates are equal.
+    order = candidates[np.lexsort((-total[candidates], -rate[candidates]))][:top]
+    print("reporter | reports | false reports | false report rate")
+    for i in order:
+        print(f"{columns.reporters[i]} | {total[i]} | {int(false[i])} | {rate[i]:.2f}")
+
+
+def print_violation_counts(columns, top):
+    counts = np.bincount(columns.author[columns.violated], minlength=len(columns.authors))
+    order = np.argsort(-counts, kind="stable")[:top]
+    print("author | violations")
+    for i in order:
+        if counts[i] == 0:
+            break
+        print(f"{columns.authors[i]} | {counts[i]}")
+
+
+def print_volume(columns, bucket_seconds):
+    has_time = ~np.isnan(columns.ts)
+    buckets = (columns.ts[has_time] // bucket_seconds).astype(np.int64)
+    starts, index, counts = np.unique(buckets, return_inverse=True, return_counts=True)
+    valid = np.bincount(index, weights=columns.violated[has_time], minlength=len(starts))
+    print("bucket start (UTC) | reports | valid reports")
+    for start, count, num_valid in zip(starts, counts, valid):
+        print(f"{np.datetime64(int(start * bucket_seconds), 's')} | {count} | {int(num_valid)}")
+    if not has_time.all():
+        print(f"({int((~has_time).sum())} reports from the old log have no timestamp)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="review log analysis")
+    parser.add_argument("query", nargs="?", default="summary", choices=["summary", "false-reports", "violations", "volume"])
+    parser.add_argument("--log-dir", default=log_dir, help="Directory that holds the review logs")
+    parser.add_argument("--top", type=int, default=20, help="Number of users to show")
+    parser.add_argument("--min-reports", type=int, default=1, help="Only show reporters with at least this many reports")
+    parser.add_argument("--bucket", default="day", help="Bucket size for `volume`: minute, hour, day or a number of seconds")
+    parser.add_argument("--rebuild", action="store_true", help="Ignore the saved columns and read the logs from the start")
+    args = parser.parse_args()
+
+    checkpoint_path = os.path.join(args.log_dir, checkpoint_name)
+    columns = ReviewColumns() if args.rebuild else ReviewColumns.load(checkpoint_path)
+    if columns.update(args.log_dir):
+        columns.save(checkpoint_path)
+
+    if args.query == "summary":
+        print_summary(columns)
+    elif args.query == "false-reports":
+        print_false_report_rates(columns, args.top, args.min_reports)
+    elif args.query == "violations":
+        print_violation_counts(columns, args.top)
+    elif args.query == "volume":
+        print_volume(columns, BUCKET_SECONDS.get(args.bucket) or float(args.bucket))
+
+
+if __name__ == "__main__":
+    main()
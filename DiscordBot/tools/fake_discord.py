@@ -0,0 +1,102 @@
+# Minimal stand-ins for the discord.py objects ModBot, Report and Review use, so the bot's handlers can be
+# driven without connecting to Discord. Only the attributes and methods the bot actually touches exist.
+
+import asyncio
+import itertools
+
+import discord
+
+_ids = itertools.count(1100000000000000000)
+
+
+def next_id():
+    return next(_ids)
+
+
+class NotFoundResponse:
+    # What discord.NotFound reads from the HTTP response it wraps
+    status = 404
+    reason = "Not Found"
+
+
+class FakeUser:
+    def __init__(self, name, id=None):
+        self.id = id or next_id()
+        self.name = name
+
+
+class FakeGuild:
+    def __init__(self, name):
+        self.id = next_id()
+        self.name = name
+        self.text_channels = []
+
+    def get_channel(self, channel_id):
+        return next((channel for channel in self.text_channels if channel.id == channel_id), None)
+
+
+class FakeChannel:
+    '''
+    Keeps every message posted to it so fetch_message works. `send_latency` simulates the REST round trip
+    of every send, fetch and delete.
+    '''
+
+    def __init__(self, name, guild=None, send_latency=0.0, on_send=None):
+        self.id = next_id()
+        self.name = name
+        self.guild = guild
+        self.send_latency = send_latency
+        self.on_send = on_send
+        self.messages = {}
+        self.sent = 0
+        self.deleted = 0
+        if guild is not None:
+            guild.text_channels.append(self)
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.send_latency)
+        self.sent += 1
+        message = FakeMessage(content or "", FakeChannel.bot_user, self)
+        if self.on_send:
+            self.on_send(message)
+        return message
+
+    async def fetch_message(self, message_id):
+        await asyncio.sleep(self.send_latency)
+        if message_id not in self.messages:
+            raise discord.NotFound(NotFoundResponse(), "Unknown Message")
+        return self.messages[message_id]
+
+    async def delete_messages(self, messages):
+        await asyncio.sleep(self.send_latency)
+        for message in messages:
+            self.messages.pop(message.id, None)
+            self.deleted += 1
+
+    def post(self, content, author):
+        return FakeMessage(content, author, self)
+
+
+# The user the bot is logged in as. Messages the bot sends are authored by it.
+FakeChannel.bot_user = None
+
+
+class FakeMessage:
+    def __init__(self, content, author, channel):
+        self.id = next_id()
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.embeds = []
+        channel.messages[self.id] = self
+
+    @property
+    def jump_url(self):
+        guild_id = self.guild.id if self.guild else "@me"
+        return f"https://discord.com/channels/{guild_id}/{self.channel.id}/{self.id}"
+
+    async def delete(self):
+        await asyncio.sleep(self.channel.send_latency)
+        if self.channel.messages.pop(self.id, None) is not None:
+            self.channel.deleted += 1
@@ -0,0 +1,177 @@
+# Drives ModBot's handlers with synthetic traffic through fake Discord objects and reports latency and
+# throughput, so performance regressions show up before deploying. Examples:
+#   python load_test.py --messages 2000 --rate 200
+#   python mock_openai.py --latency-ms 800 &   # and "openai-api-base" in tokens.json, see mock_openai.py
+#   python load_test.py --openai --messages 500 --reports 20 --reviews 10
+# Chat messages arrive at --rate messages per second (0 sends them all at once) while user reports and
+# moderator reviews are walked through their flows step by step.
+
+import argparse
+import asyncio
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+
+from fake_discord import FakeChannel, FakeGuild, FakeUser
+
+# bot.py reads tokens.json and data/ relative to the working directory.
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+os.chdir(BOT_DIR)
+
+import bot as bot_module
+from review_log import ReviewLogWriter
+
+DATASETS = ["harassment.csv", "edge.csv", "not.csv"]
+
+
+def load_texts():
+    texts = []
+    for name in DATASETS:
+        with open(name) as f:
+            reader = csv.reader(f)
+            next(reader)
+            for row in reader:
+                # formatter.unformat_str_to_dict can't handle these, and real reports would trip on them too.
+                texts.append(row[0].replace("\n", " ").replace(": ", " "))
+    return texts
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class LoadTest:
+    def __init__(self, args, log_dir):
+        self.args = args
+        self.latencies = {} # Map from event kind to list of seconds each handler call took
+
+        self.bot_user = FakeUser("Group 0 Bot")
+        FakeChannel.bot_user = self.bot_user
+        self.guild = FakeGuild("Load Test Server")
+        self.channel = FakeChannel("group-0", self.guild, args.discord_latency_ms / 1000)
+        self.mod_channel = FakeChannel("group-0-mod", self.guild, args.discord_latency_ms / 1000)
+        self.users = [FakeUser(f"user{i}") for i in range(args.users)]
+        self.moderators = [FakeUser(f"moderator{i}") for i in range(max(1, args.moderators))]
+
+        self.client = bot_module.ModBot(use_openai=self.args.openai, state_db=None, cascade=self.args.cascade,
+                                        openai_deadline=self.args.openai_deadline, openai_slow_call=self.args.openai_slow_call, hedge=self.args.hedge,
+                                        flood_window=self.args.flood_window, digest_reports=self.args.digest_reports,
+                                        local_workers=self.args.local_workers)
+        self.client._connection.user = self.bot_user
+        self.client.get_guild = lambda guild_id: self.guild if guild_id == self.guild.id else None
+        self.client.group_num = "0"
+        self.client.mod_channels[self.guild.id] = self.mod_channel
+        self.client.single_mod_channel = self.mod_channel
+        self.client.review_log = ReviewLogWriter(os.path.join(log_dir, "reviews.jsonl"))
+
+    async def timed(self, kind, message):
+        start = time.perf_counter()
+        try:
+            await self.client.on_message(message)
+        except Exception as e:
+            kind += " (failed)"
+            if self.args.verbose:
+                print(f"{kind}: {type(e).__name__}: {e}")
+        self.latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    async def chat_traffic(self, texts):
+        tasks = []
+        raid_text = random.choice(texts)
+        for i in range(self.args.messages):
+            text = random.choice(texts)
+            if random.random() < self.args.raid:
+                # Raiders vary their copies a little so exact matching doesn't catch them.
+                text = raid_text + random.choice(["", "!", "!!", " ?", " :)"])
+            message = self.channel.post(text, random.choice(self.users))
+            tasks.append(asyncio.create_task(self.timed("chat message", message)))
+            if self.args.rate > 0:
+                await asyncio.sleep(1 / self.args.rate)
+        await asyncio.gather(*tasks)
+
+    async def report(self, reporter):
+        dm_channel = FakeChannel(f"dm-{reporter.name}", None, self.args.discord_latency_ms / 1000)
+        candidates = [m for m in self.channel.messages.values() if m.author is not self.bot_user]
+        if not candidates:
+            return
+        target = random.choice(candidates)
+        for step in ["report", target.jump_url, "2"]:
+            await self.timed("report step", dm_channel.post(step, reporter))
+
+    async def review(self, moderator, mod_message):
+        # With --next moderators take reports from the review queue instead of pasting links.
+        first_steps = ["next"] if self.args.next else ["review", mod_message.jump_url]
+        for step in first_steps + [random.choice(["1", "3"]), "n"]:
+            await self.timed("review step", self.mod_channel.post(step, moderator))
+            if moderator.id not in self.client.inprogress_reviews:
+                break
+
+    async def run(self):
+        await self.client.setup_hook()
+        texts = load_texts()
+
+        start = time.perf_counter()
+        chat = asyncio.create_task(self.chat_traffic(texts))
+        # Let some chat arrive before anyone reports it.
+        await asyncio.sleep(0.1)
+        reporters = random.sample(self.users, min(self.args.reports, len(self.users)))
+        await asyncio.gather(*(self.report(reporter) for reporter in reporters))
+        await chat
+        chat_seconds = time.perf_counter() - start
+
+        mod_messages = [m for m in self.mod_channel.messages.values() if m.author is self.bot_user and m.content.startswith("`reporter`")]
+        for i, mod_message in enumerate(mod_messages[:self.args.reviews]):
+            await self.review(self.moderators[i % len(self.moderators)], mod_message)
+
+        await self.client.review_log.close()
+        self.print_results(chat_seconds)
+
+    def print_results(self, chat_seconds):
+        print(f"{self.args.messages} chat messages in {chat_seconds:.2f}s: {self.args.messages / chat_seconds:.1f} msgs/sec")
+        print(f"Discord calls: {self.channel.sent + self.mod_channel.sent} sends, {self.channel.deleted} deletes")
+        print()
+        print("event | count | p50 | p95 | p99 | max")
+        for kind, values in self.latencies.items():
+            values = sorted(values)
+            print(f"{kind} | {len(values)} | {percentile(values, 0.5) * 1000:.1f}ms | {percentile(values, 0.95) * 1000:.1f}ms | "
+                  f"{percentile(values, 0.99) * 1000:.1f}ms | {values[-1] * 1000:.1f}ms")
+        print()
+        print("Per-stage metrics (same as the `stats` command):")
+        print(self.client.metrics.format_text())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ModBot load test")
+    parser.add_argument("--messages", type=int, default=1000, help="Number of chat messages to send")
+    parser.add_argument("--rate", type=float, default=100, help="Chat messages per second (0 sends them all at once)")
+    parser.add_argument("--users", type=int, default=50, help="Number of chatting users")
+    parser.add_argument("--reports", type=int, default=10, help="Number of users who report a message")
+    parser.add_argument("--reviews", type=int, default=10, help="Number of reports moderators review")
+    parser.add_argument("--moderators", type=int, default=2)
+    parser.add_argument("--flood-window", type=float, default=10, help="Flood control window of the bot (0 disables, to measure the full pipeline)")
+    parser.add_argument("--digest-reports", action="store_true", help="Send automatic reports as digests")
+    parser.add_argument("--local-workers", type=int, default=0, help="Worker processes for local scoring (0 scores on the event loop)")
+    parser.add_argument("--raid", type=float, default=0, help="Fraction of chat messages that are near-copies of one text")
+    parser.add_argument("--next", action="store_true", help="Moderators use the `next` command instead of pasting report links")
+    parser.add_argument("--discord-latency-ms", type=float, default=50, help="Simulated time of every Discord API call")
+    parser.add_argument("--openai", action="store_true", help="Use OpenAI detection (point it at mock_openai.py)")
+    parser.add_argument("--cascade", action="store_true", help="Only send messages profanity_check is unsure about to OpenAI")
+    parser.add_argument("--openai-deadline", type=float, default=5.0, help="Seconds a message waits for OpenAI")
+    parser.add_argument("--openai-slow-call", type=float, default=2.0, help="OpenAI replies slower than this count towards opening the circuit breaker")
+    parser.add_argument("--hedge", action="store_true", help="Run profanity_check alongside every OpenAI request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Print handler errors")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as log_dir:
+        asyncio.run(LoadTest(args, log_dir).run())
+
+
+if __name__ == "__main__":
+    main()
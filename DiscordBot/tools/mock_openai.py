@@ -0,0 +1,151 @@
+# Local stand-in for the OpenAI ChatCompletion endpoint, so the bot and eval.py can be benchmarked offline.
+# Replies use the format the prompt in openai_utils.py asks for (category lines or a compact format), with scores made up from
+# the banned word list. Point the bot at it by adding `"openai-api-base": "http://127.0.0.1:8080/v1"`
+# to tokens.json, then run:
+#   python mock_openai.py --latency-ms 800 --jitter-ms 400 --error-rate 0.02
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+
+from aiohttp import web
+
+# Same categories, in the same order, as the prompt in openai_utils.py
+CATEGORIES = [
+    "Scam",
+    "Offensive Content",
+    "Harrassment and bullying",
+    "Harrassment and unwanted sexual content",
+    "Harrassment and leaking private Information",
+    "Harrassment and hate speech on certain groups",
+    "Danger",
+    "Illegally published content",
+    "Misinformation",
+]
+
+DANGER_WORDS = {"kill", "die", "dead", "shoot", "fire", "hurt"}
+
+
+def load_banned_words(path):
+    with open(path) as f:
+        return {line.strip().lower() for line in f if line.strip() and not line.startswith("#")}
+
+
+def score_text(text, banned_words):
+    '''
+    Made-up but repeatable scores: more banned words means more offensive, aimed at "you" means harassment.
+    '''
+    words = re.findall(r"[a-z']+", text.lower())
+    hits = sum(1 for word in words if word in banned_words)
+    scores = {category: 1 for category in CATEGORIES}
+    scores["Offensive Content"] = min(5, 1 + 2 * hits)
+    if hits and ("you" in words or "your" in words):
+        scores["Harrassment and bullying"] = min(5, 2 + hits)
+    if DANGER_WORDS.intersection(words):
+        scores["Danger"] = 5 if "you" in words else 3
+    return scores
+
+
+def format_scores(scores):
+    return "\n".join(f"{category}: {scores[category]}" for category in CATEGORIES)
+
+
+def response_format_of(prompt, body):
+    # Matches the reply instructions of openai_utils.build_compact_prompt
+    if body.get('functions'):
+        return "function"
+    if "digits and nothing else" in prompt or "digits, one per category" in prompt:
+        return "digits"
+    if "JSON array" in prompt:
+        return "json"
+    return "text"
+
+
+def reply_for(prompt, banned_words, response_format="text"):
+    # Batched prompts (openai_utils.build_batch_prompt) number their inputs, single prompts end with the text.
+    if "User inputs:" in prompt:
+        inputs = prompt.split("User inputs:", 1)[1]
+        items = [(number, json.loads(text)) for number, text in re.findall(r'^\s*Input (\d+): (".*")$', inputs, flags=re.MULTILINE)]
+        all_scores = [[score_text(text, banned_words)[category] for category in CATEGORIES] for _, text in items]
+        if response_format == "digits":
+            return "\n".join(f"{number}: " + "".join(map(str, scores)) for (number, _), scores in zip(items, all_scores))
+        if response_format == "json":
+            return json.dumps(all_scores)
+        if response_format == "function":
+            return json.dumps({'scores': all_scores})
+        return "\n\n".join(f"Input {number}:\n" + format_scores(score_text(text, banned_words)) for number, text in items)
+
+    text = prompt.split("User input:", 1)[-1]
+    scores = score_text(text, banned_words)
+    if response_format == "digits":
+        return "".join(str(scores[category]) for category in CATEGORIES)
+    if response_format == "json":
+        return json.dumps([scores[category] for category in CATEGORIES])
+    if response_format == "function":
+        return json.dumps({'scores': [scores[category] for category in CATEGORIES]})
+    return format_scores(scores)
+
+
+class MockOpenAI:
+    def __init__(self, args):
+        self.args = args
+        self.banned_words = load_banned_words(args.banned_words)
+        self.requests = 0
+        self.errors = 0
+
+    async def chat_completions(self, request):
+        self.requests += 1
+        body = await request.json()
+        prompt = body['messages'][-1]['content']
+
+        delay = max(0, random.gauss(self.args.latency_ms, self.args.jitter_ms)) / 1000
+        if random.random() < self.args.slow_rate:
+            delay = self.args.slow_ms / 1000
+        await asyncio.sleep(delay)
+
+        if random.random() < self.args.error_rate:
+            self.errors += 1
+            return web.json_response({'error': {'message': "Mock server error", 'type': "server_error"}}, status=500)
+
+        response_format = response_format_of(prompt, body)
+        content = reply_for(prompt, self.banned_words, response_format)
+        message = {'role': "assistant", 'content': content}
+        if response_format == "function":
+            message = {'role': "assistant", 'content': None, 'function_call': {'name': "report_scores", 'arguments': content}}
+        return web.json_response({
+            'id': f"chatcmpl-mock-{self.requests}",
+            'object': "chat.completion",
+            'created': int(time.time()),
+            'model': body.get('model', "gpt-3.5-turbo"),
+            'choices': [{'index': 0, 'message': message, 'finish_reason': "stop"}],
+            'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4, 'total_tokens': (len(prompt) + len(content)) // 4},
+        })
+
+    async def stats(self, request):
+        return web.json_response({'requests': self.requests, 'errors': self.errors})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mock OpenAI ChatCompletion server")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency-ms", type=float, default=1000, help="Mean response time")
+    parser.add_argument("--jitter-ms", type=float, default=300, help="Standard deviation of the response time")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail with HTTP 500")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Fraction of requests that take --slow-ms instead")
+    parser.add_argument("--slow-ms", type=float, default=30000)
+    parser.add_argument("--banned-words", default="../data/badwords.txt")
+    args = parser.parse_args()
+
+    mock = MockOpenAI(args)
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", mock.chat_completions)
+    app.router.add_post("/chat/completions", mock.chat_completions)
+    app.router.add_get("/stats", mock.stats)
+    web.run_app(app, host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+# Measures how well the automatic detection rules in bot.py do on the scored datasets (see eval.py), and
+# how they would do with other thresholds. Every rule "at least K categories scored T or higher" and every
+# profanity_check threshold is evaluated at once with NumPy, then the rule that flags the fewest messages
+# while still reaching the recall target is suggested. Example:
+#   python threshold_sweep.py --recall 0.9 --table
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# local_scoring.py (the bot's sanitizing and profanity_check scoring) lives one directory up.
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+# Scored datasets and whether their messages should be flagged.
+DATASETS = [
+    ("harassment-output.csv", "harassment"),
+    ("edge-output.csv", "edge"),
+    ("output.csv", "not"),
+]
+
+# The rules bot.py uses today, as (category threshold, minimum number of categories).
+CURRENT_OPENAI_RULES = {'delete': (4, 2), 'report': (4, 1)}
+CURRENT_PROFANITY_RULES = {'delete': 0.95, 'report': 0.4}
+
+SCORE_THRESHOLDS = np.arange(1, 6)
+CATEGORY_COUNTS = np.arange(1, 10)
+PROFANITY_THRESHOLDS = np.round(np.arange(0.05, 1.0, 0.05), 2)
+
+
+def load_datasets(data_dir, edge_label):
+    '''
+    Returns (texts, 2D array of category scores, labels, names of the files the rows came from).
+    '''
+    labels_for = {'harassment': True, 'not': False, 'edge': edge_label == "positive"}
+    texts, scores, labels, sources = [], [], [], []
+    for name, kind in DATASETS:
+        if kind == "edge" and edge_label == "ignore":
+            continue
+        path = os.path.join(data_dir, name)
+        if not os.path.exists(path):
+            print(f"Skipping {name}, it doesn't exist. Run eval.py first.")
+            continue
+        with open(path) as f:
+            reader = csv.reader(f)
+            next(reader)
+            for row in reader:
+                if len(row) != 10:
+                    continue
+                texts.append(row[0])
+                scores.append([int(score) for score in row[1:]])
+                labels.append(labels_for[kind])
+                sources.append(name)
+    return texts, np.array(scores, dtype=np.int8).reshape(-1, 9), np.array(labels, dtype=bool), sources
+
+
+def confusion_counts(predicted, labels):
+    '''
+    `predicted` has one row of predictions per rule on its last axis. Returns TP, FP, FN, TN arrays over the rules.
+    '''
+    tp = (predicted & labels).sum(-1)
+    fp = (predicted & ~labels).sum(-1)
+    fn = (~predicted & labels).sum(-1)
+    tn = (~predicted & ~labels).sum(-1)
+    return tp, fp, fn, tn
+
+
+def precision_recall(tp, fp, fn):
+    precision = np.divide(tp, tp + fp, out=np.zeros(np.shape(tp)), where=(tp + fp) > 0)
+    recall = np.divide(tp, tp + fn, out=np.zeros(np.shape(tp)), where=(tp + fn) > 0)
+    return precision, recall
+
+
+def sweep_openai_rules(scores, labels):
+    # counts[t, i] is how many categories of message i scored at least SCORE_THRESHOLDS[t]
+    counts = (scores[None, :, :] >= SCORE_THRESHOLDS[:, None, None]).sum(-1)
+    # predicted[t, k, i] is whether message i is flagged by "at least CATEGORY_COUNTS[k] categories >= SCORE_THRESHOLDS[t]"
+    predicted = counts[:, None, :] >= CATEGORY_COUNTS[None, :, None]
+    return confusion_counts(predicted, labels)
+
+
+def sweep_profanity_thresholds(profanity_scores, labels):
+    predicted = profanity_scores[None, :] > PROFANITY_THRESHOLDS[:, None]
+    return confusion_counts(predicted, labels)
+
+
+def print_confusion(title, tp, fp, fn, tn):
+    precision, recall = precision_recall(tp, fp, fn)
+    print(title)
+    print("                 flagged   not flagged")
+    print(f"  harmful        {tp:7d}   {fn:11d}")
+    print(f"  not harmful    {fp:7d}   {tn:11d}")
+    print(f"  precision {precision:.2f}, recall {recall:.2f}")
+    print()
+
+
+def print_sweep_table(rules, tp, fp, fn, tn):
+    precision, recall = precision_recall(tp, fp, fn)
+    print("rule | flagged | precision | recall")
+    for i, rule in enumerate(rules):
+        print(f"{rule} | {tp[i] + fp[i]} | {precision[i]:.2f} | {recall[i]:.2f}")
+    print()
+
+
+def cheapest_rule(rules, tp, fp, fn, recall_target):
+    '''
+    Index of the rule that flags the fewest messages (the least work for moderators) among the rules that
+    reach the recall target. Ties go to the more precise rule. None if no rule reaches the target.
+    '''
+    precision, recall = precision_recall(tp, fp, fn)
+    meets = np.flatnonzero(recall >= recall_target)
+    if len(meets) == 0:
+        return None
+    flagged = (tp + fp)[meets]
+    return meets[np.lexsort((-precision[meets], flagged))[0]]
+
+
+def latency_stats(latencies):
+    latencies = np.asarray(latencies, dtype=np.float64)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return f"n={len(latencies)} mean={latencies.mean() * 1000:.1f}ms p50={p50 * 1000:.1f}ms p95={p95 * 1000:.1f}ms p99={p99 * 1000:.1f}ms"
+
+
+def load_openai_latencies(data_dir):
+    '''
+    eval.py records how long each OpenAI request took in its checkpoint files.
+    '''
+    latencies = []
+    for name, _ in DATASETS:
+        path = os.path.join(data_dir, name + ".ckpt.jsonl")
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            for line in f:
+                try:
+                    latency = json.loads(line).get('latency')
+                except json.JSONDecodeError:
+                    continue
+                if latency is not None:
+                    latencies.append(latency)
+    return latencies
+
+
+def score_with_profanity_check(texts):
+    '''
+    Returns (scores, per-message latencies) or (None, None) if profanity_check isn't installed. Messages are
+    sanitized first, like the bot does, so thresholds are swept over the scores the bot actually sees.
+    '''
+    try:
+        import local_scoring
+    except ImportError:
+        return None, None
+    local_scoring.banned_words_path = os.path.join(BOT_DIR, local_scoring.banned_words_path)
+    scores = local_scoring.sanitize_and_score(texts)
+    latencies = []
+    for text in texts:
+        start = time.perf_counter()
+        local_scoring.sanitize_and_score([text])
+        latencies.append(time.perf_counter() - start)
+    return np.asarray(scores, dtype=np.float64), latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="threshold sweep over the scored datasets")
+    parser.add_argument("--data-dir", default="..", help="Directory that holds the *-output.csv files")
+    parser.add_argument("--recall", type=float, default=0.9, help="Recall the suggested rule has to reach")
+    parser.add_argument("--edge", default="positive", choices=["positive", "negative", "ignore"], help="How to count edge-output.csv")
+    parser.add_argument("--table", action="store_true", help="Print every rule, not just the current and suggested ones")
+    args = parser.parse_args()
+
+    texts, scores, labels, sources = load_datasets(args.data_dir, args.edge)
+    if len(labels) == 0:
+        print("No scored rows found.")
+        return
+    print(f"{len(labels)} messages, {int(labels.sum())} harmful and {int((~labels).sum())} not harmful\n")
+
+    print("=== OpenAI category scores ===\n")
+    tp, fp, fn, tn = sweep_openai_rules(scores, labels)
+    rules = [(t, k) for t in SCORE_THRESHOLDS for k in CATEGORY_COUNTS]
+    tp, fp, fn, tn = tp.ravel(), fp.ravel(), fn.ravel(), tn.ravel()
+
+    for action, rule in CURRENT_OPENAI_RULES.items():
+        i = rules.index(rule)
+        print_confusion(f"Current {action} rule: at least {rule[1]} categories >= {rule[0]}", tp[i], fp[i], fn[i], tn[i])
+
+    if args.table:
+        print_sweep_table([f"at least {k} categories >= {t}" for t, k in rules], tp, fp, fn, tn)
+
+    best = cheapest_rule(rules, tp, fp, fn, args.recall)
+    if best is None:
+        print(f"No category rule reaches recall {args.recall}.\n")
+    else:
+        t, k = rules[best]
+        print_confusion(f"Suggested rule for recall >= {args.recall}: at least {k} categories >= {t}", tp[best], fp[best], fn[best], tn[best])
+
+    profanity_scores, profanity_latencies = score_with_profanity_check(texts)
+    if profanity_scores is not None:
+        print("=== profanity_check scores ===\n")
+        tp, fp, fn, tn = sweep_profanity_thresholds(profanity_scores, labels)
+        thresholds = list(PROFANITY_THRESHOLDS)
+
+        for action, threshold in CURRENT_PROFANITY_RULES.items():
+            i = int(np.argmin(np.abs(PROFANITY_THRESHOLDS - threshold)))
+            print_confusion(f"Current {action} rule: score > {thresholds[i]}", tp[i], fp[i], fn[i], tn[i])
+
+        if args.table:
+            print_sweep_table([f"score > {t}" for t in thresholds], tp, fp, fn, tn)
+
+        best = cheapest_rule(thresholds, tp, fp, fn, args.recall)
+        if best is None:
+            print(f"No profanity_check threshold reaches recall {args.recall}.\n")
+        else:
+            print_confusion(f"Suggested threshold for recall >= {args.recall}: score > {thresholds[best]}", tp[best], fp[best], fn[best], tn[best])
+
+    print("=== Classifier latency ===\n")
+    openai_latencies = load_openai_latencies(args.data_dir)
+    if openai_latencies:
+        print("OpenAI (from eval.py checkpoints):", latency_stats(openai_latencies))
+    else:
+        print("OpenAI: no latencies recorded, run eval.py to collect them.")
+    if profanity_latencies:
+        print("sanitize + profanity_check (one message per call):", latency_stats(profanity_latencies))
+    else:
+        print("profanity_check: not installed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# Cache for classifier verdicts, so repeated content doesn't get scored again.
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('modbot.cache')
+
+
+class VerdictCache:
+    '''
+    Two-tier cache of classifier results. The first tier is an in-memory LRU with a time-to-live,
+    the second (optional) tier is a SQLite file so verdicts survive restarts and eval reruns.
+    Entries are keyed on a namespace (which classifier produced the verdict) and the text that was scored.
+    Values must be JSON serializable if the disk tier is used.
+
+    Lookups never touch the disk: the newest `max_entries` verdicts are loaded from the file when the cache
+    is created. New verdicts are queued and written in one transaction every `flush_interval` seconds on a
+    worker thread (see `start`), the same way StateStore does it.
+    '''
+
+    def __init__(self, max_entries=10000, ttl_seconds=3600, db_path=None, flush_interval=1.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.flush_interval = flush_interval
+        self.entries = OrderedDict() # Map from key to (time stored, value), oldest first
+        self.hits = 0
+        self.misses = 0
+        self.loaded = 0
+
+        self.db = None
+        self.pending = [] # List of (key, value as JSON, time stored) waiting to be written
+        self.flush_task = None
+        self.executor = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS verdicts (key TEXT PRIMARY KEY, value TEXT, stored REAL)")
+            self.db.commit()
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="verdict-cache")
+            self.load()
+
+    def load(self):
+        rows = self.db.execute("SELECT key, value, stored FROM verdicts ORDER BY stored DESC LIMIT ?", (self.max_entries,)).fetchall()
+        now = time.time()
+        # Oldest first, so the LRU order matches the order they were stored in.
+        for key, value, stored in reversed(rows):
+            if not self.is_expired(stored, now):
+                self.remember(key, json.loads(value, object_pairs_hook=OrderedDict), stored)
+        self.loaded = len(self.entries)
+
+    def get(self, namespace, text):
+        key = self.make_key(namespace, text)
+        now = time.time()
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            if not self.is_expired(entry[0], now):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.entries.pop(key)
+
+        self.misses += 1
+        return None
+
+    def put(self, namespace, text, value):
+        key = self.make_key(namespace, text)
+        stored = time.time()
+        self.remember(key, value, stored)
+
+        if self.db is not None:
+            self.pending.append((key, json.dumps(value), stored))
+
+    def start(self):
+        if self.db is not None and self.flush_task is None:
+            self.flush_task = asyncio.get_running_loop().create_task(self.flush_periodically())
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except sqlite3.Error as e:
+                logger.warning("Failed to write verdicts: %s", e)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch = self.pending
+        self.pending = []
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.write_batch, batch)
+
+    def write_batch(self, batch):
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO verdicts (key, value, stored) VALUES (?, ?, ?)", batch)
+
+    def remember(self, key, value, stored):
+        self.entries[key] = (stored, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def is_expired(self, stored, now):
+        return self.ttl_seconds is not None and now - stored > self.ttl_seconds
+
+    def make_key(self, namespace, text):
+        return f"{namespace}:{text}"
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'loaded': self.loaded}
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        if self.db is not None:
+            await self.flush()
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.db.close)
+            self.executor.shutdown()
+            self.db = None